@@ -0,0 +1,314 @@
+# benchmark.py - timings of the loaders, the map and the statistics paths at growing data sizes
+#
+# Every scale runs in its own process inside a scratch directory that mirrors
+# data/: scale 1 links the shipped files, larger scales replace the point and
+# income sources with synthetic copies (jittered duplicates of the real rows).
+# The municipality boundaries stay the same at every scale. Caches start empty,
+# so the first request of each run is a real cold start. The loaders are timed
+# twice: with the persistent caches of the run warm, and at the end with the
+# scratch data/cache emptied before every call (the *_cold timings).
+#
+# Results are written as JSON, one file per commit, to benchmarks/ (ignored by
+# git) and can be compared with an earlier run to spot regressions.
+#
+# Usage: python benchmark.py [--scales 1,10,100] [--repeat 3] [--data-dir data]
+#                            [--output FILE] [--compare BASELINE.json]
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(REPO_DIR, 'benchmarks')
+
+# Persistent caches of a benchmark run, relative to its scratch directory
+SCRATCH_CACHE_DIR = os.path.join('data', 'cache')
+
+HOTSPOTS_FILE = 'public_hotspots.geojson'
+PUBLICITY_FILE = 'publicity_locations.geojson'
+COMPETITORS_FILE = 'competitors.json'
+COMMERCIAL_FILE = 'commercial_spaces.csv'
+INCOME_FILE = 'income_by_municipality_utf8.csv'
+
+# Standard deviation of the position jitter of synthetic copies
+JITTER_DEGREES = 0.01
+JITTER_METRES = 1000
+
+# ----- Synthetic data -----
+
+def _jitter_geometries(geometries, rng, scale):
+    """Move every geometry by its own random offset, keeping its shape."""
+    _, index = shapely.get_coordinates(geometries, return_index=True)
+    offsets = rng.normal(0, scale, (len(geometries), 2))
+    return shapely.transform(geometries, lambda coordinates: coordinates + offsets[index])
+
+def scale_geojson(source, target, factor, rng):
+    """Write factor jittered copies of every feature of a GeoJSON file."""
+    gdf = gpd.read_file(source)
+    copies = [gdf]
+    for _ in range(factor - 1):
+        copy = gdf.copy()
+        copy['geometry'] = _jitter_geometries(gdf.geometry.values, rng, JITTER_DEGREES)
+        copies.append(copy)
+    gpd.GeoDataFrame(pd.concat(copies, ignore_index=True), crs=gdf.crs).to_file(target, driver='GeoJSON')
+
+def scale_competitors(source, target, factor, rng):
+    """Write factor jittered copies of every competitor, each with its own place_id."""
+    with open(source) as f:
+        competitors = json.load(f)
+    scaled = list(competitors)
+    for copy in range(1, factor):
+        offsets = rng.normal(0, JITTER_DEGREES, (len(competitors), 2))
+        for competitor, (dlat, dlng) in zip(competitors, offsets):
+            competitor = json.loads(json.dumps(competitor))
+            location = competitor['geometry']['location']
+            location['lat'] += dlat
+            location['lng'] += dlng
+            competitor['place_id'] = f"{competitor.get('place_id', '')}-{copy}"
+            scaled.append(competitor)
+    with open(target, 'w') as f:
+        json.dump(scaled, f)
+
+def scale_commercial(source, target, factor, rng):
+    """Write factor jittered copies of every commercial space row."""
+    commercial = pd.read_csv(source)
+    copies = [commercial]
+    for copy in range(1, factor):
+        scaled = commercial.copy()
+        scaled['id'] = commercial['id'] + copy * (commercial['id'].max() + 1)
+        scaled['E_COORD'] = (commercial['E_COORD'] + rng.normal(0, JITTER_METRES, len(commercial))).round()
+        scaled['N_COORD'] = (commercial['N_COORD'] + rng.normal(0, JITTER_METRES, len(commercial))).round()
+        copies.append(scaled)
+    pd.concat(copies, ignore_index=True).to_csv(target, index=False)
+
+def scale_income(source, target, factor):
+    """Append renamed copies of the income rows; they match no municipality and go through fuzzy matching."""
+    income = pd.read_csv(source, header=None, dtype=str)
+    copies = [income]
+    for copy in range(1, factor):
+        scaled = income.copy()
+        scaled[0] = (income[0].astype(int) + copy * 100000).astype(str)
+        scaled[1] = income[1] + f" {copy}"
+        copies.append(scaled)
+    pd.concat(copies, ignore_index=True).to_csv(target, header=False, index=False)
+
+def generate_dataset(data_dir, target_dir, factor, seed=0):
+    """Mirror data_dir into target_dir, replacing the scalable sources with factor-times larger copies."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(target_dir, exist_ok=True)
+    generators = {
+        HOTSPOTS_FILE: lambda source, target: scale_geojson(source, target, factor, rng),
+        PUBLICITY_FILE: lambda source, target: scale_geojson(source, target, factor, rng),
+        COMPETITORS_FILE: lambda source, target: scale_competitors(source, target, factor, rng),
+        COMMERCIAL_FILE: lambda source, target: scale_commercial(source, target, factor, rng),
+        INCOME_FILE: lambda source, target: scale_income(source, target, factor),
+    }
+    for name in os.listdir(data_dir):
+        source = os.path.abspath(os.path.join(data_dir, name))
+        target = os.path.join(target_dir, name)
+        if name == 'cache':
+            continue
+        if factor > 1 and name in generators:
+            generators[name](source, target)
+        else:
+            os.symlink(source, target)
+
+def dataset_sizes(data_dir):
+    """Return the size in bytes of every source file of a data directory."""
+    sizes = {}
+    for name in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, name)
+        if os.path.isfile(path):
+            sizes[name] = os.path.getsize(path)
+    return sizes
+
+# ----- Benchmarks -----
+
+def _timing(times):
+    return {
+        'min': round(min(times), 6),
+        'median': round(statistics.median(times), 6),
+        'max': round(max(times), 6),
+        'runs': len(times),
+    }
+
+def measure(function, repeat, setup=None):
+    """Call function repeat times and return min/median/max wall time in seconds."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return _timing(times)
+
+def _get(client, url):
+    response = client.get(url)
+    if response.status_code != 200:
+        raise RuntimeError(f"{url} returned {response.status_code}")
+    return response
+
+def run_benchmarks(repeat=3):
+    """Time every stage against the data/ directory of the current working directory."""
+    import main
+    from datasets import (
+        get_dataset,
+        load_and_merge_income_data,
+        load_competitors,
+        load_hotspots,
+        load_municipalities,
+        load_publicity_locations,
+    )
+    import map_cache
+    from map_cache import clear_map_cache
+    from projection import load_commercial_coordinates
+    from scoring import build_feature_matrix
+
+    client = main.app.test_client()
+    results = {}
+
+    # First requests of a fresh process, with every dataset still unloaded
+    results['get_map_first_request'] = measure(lambda: _get(client, '/get_map'), 1)
+    results['statistics_first_request'] = measure(lambda: _get(client, '/api/statistics'), 1)
+
+    # Loaders, called directly so that the registry does not hand out cached results
+    loaders = {
+        'load_municipalities': load_municipalities,
+        'load_hotspots': load_hotspots,
+        'load_publicity_locations': load_publicity_locations,
+        'load_competitors': load_competitors,
+        'load_commercial_coordinates': load_commercial_coordinates,
+        'build_feature_matrix': build_feature_matrix,
+    }
+    for name, loader in loaders.items():
+        results[name] = measure(loader, repeat)
+
+    municipalities = get_dataset('municipalities')
+    results['load_and_merge_income_data'] = measure(lambda: load_and_merge_income_data(municipalities), repeat)
+
+    results['create_heatmap'] = measure(
+        lambda: main.create_heatmap(point_layers=main.segment_point_layers(main.DEFAULT_SEGMENT)).get_root().render(), repeat)
+
+    # Map read back from the persisted rendering, rebuilt from loaded data, then served from memory
+    results['get_map_persisted'] = measure(lambda: _get(client, '/get_map'), repeat, setup=clear_map_cache)
+    map_cache.PERSIST_MAPS = False
+    results['get_map_rebuild'] = measure(lambda: _get(client, '/get_map'), repeat, setup=clear_map_cache)
+    map_cache.PERSIST_MAPS = True
+    results['get_map_cached'] = measure(lambda: _get(client, '/get_map'), repeat)
+    results['statistics_cached'] = measure(lambda: _get(client, '/api/statistics'), repeat)
+
+    # Loaders with the persistent caches (boundary artifact, prepared sources,
+    # income match table, commercial assignment) emptied before every call.
+    # Last, so that the timings above run against the caches they would find.
+    def clear_caches():
+        shutil.rmtree(SCRATCH_CACHE_DIR, ignore_errors=True)
+
+    # build_feature_matrix only reads loaded datasets, it has no cold path of its own
+    cold_loaders = {name: loader for name, loader in loaders.items() if name != 'build_feature_matrix'}
+    cold_loaders['load_and_merge_income_data'] = lambda: load_and_merge_income_data(municipalities)
+    for name, loader in cold_loaders.items():
+        results[f"{name}_cold"] = measure(loader, repeat, setup=clear_caches)
+    return results
+
+def _run_scale(data_dir, factor, repeat):
+    """Generate the data of one scale in a scratch directory and benchmark it in a fresh process."""
+    with tempfile.TemporaryDirectory(prefix=f"benchmark_x{factor}_") as work_dir:
+        print(f"Generating data at {factor}x scale")
+        scratch_data_dir = os.path.join(work_dir, 'data')
+        generate_dataset(data_dir, scratch_data_dir, factor, seed=factor)
+
+        print(f"Benchmarking at {factor}x scale")
+        results_path = os.path.join(work_dir, 'results.json')
+        log_path = os.path.join(work_dir, 'benchmark.log')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+        with open(log_path, 'w') as log:
+            process = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run', '--repeat', str(repeat), '--output', results_path],
+                cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT,
+            )
+        if process.returncode != 0:
+            with open(log_path) as log:
+                print(log.read()[-4000:])
+            raise RuntimeError(f"Benchmark at {factor}x scale failed")
+
+        with open(results_path) as f:
+            timings = json.load(f)
+        return {'sizes': dataset_sizes(scratch_data_dir), 'timings': timings}
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(results, baseline):
+    """Print the median time of every benchmark next to a baseline run."""
+    print(f"{'scale':>6} {'benchmark':<34} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for factor, scale in results['scales'].items():
+        previous = baseline['scales'].get(factor, {}).get('timings', {})
+        for name, timing in scale['timings'].items():
+            if name not in previous:
+                continue
+            before, after = previous[name]['median'], timing['median']
+            ratio = after / before if before else float('inf')
+            print(f"{factor + 'x':>6} {name:<34} {before:>10.4f} {after:>10.4f} {ratio:>6.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the loaders, /get_map and /api/statistics at growing data sizes.')
+    parser.add_argument('--scales', default='1,10,100', help='comma-separated scale factors')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark')
+    parser.add_argument('--data-dir', default=os.path.join(REPO_DIR, 'data'), help='source data directory')
+    parser.add_argument('--output', help='results file (default: benchmarks/<commit>.json)')
+    parser.add_argument('--compare', help='earlier results file to compare with')
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Child process: benchmark the data/ directory of the working directory
+    if args.run:
+        results = run_benchmarks(args.repeat)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        return
+
+    commit = _git_commit()
+    results = {
+        'commit': commit,
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'scales': {},
+    }
+    for factor in [int(factor) for factor in args.scales.split(',')]:
+        results['scales'][str(factor)] = _run_scale(args.data_dir, factor, args.repeat)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {output}")
+
+    for factor, scale in results['scales'].items():
+        for name, timing in scale['timings'].items():
+            print(f"{factor + 'x':>6} {name:<34} {timing['median']:>10.4f}s")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+# boundaries.py - precompiled GeoParquet cache of the swissBOUNDARIES3D municipality layer
+#
+# Decoding the FileGDB is by far the slowest part of loading the map data. This
+# module runs the expensive part once: it reads TLM_HOHEITSGEBIET, keeps the
+# German-speaking municipalities and the columns the app uses, reprojects them to
+# WGS84 and writes the result to a GeoParquet file named after a hash of the
+# geodatabase. The app then only ever reads that file.
+#
+# Next to the full-resolution geometry the file holds a pyramid of simplified
+# levels of detail (LOD). They are built with coverage simplification in LV95,
+# so borders shared by two municipalities are simplified once and stay shared.
+# Readers select one level by column, without decoding the others.
+#
+# Usage: python boundaries.py [--force]
+import hashlib
+import json
+import math
+import os
+import sys
+import threading
+
+import geopandas as gpd
+import shapely
+
+from metrics import record_size, stage
+
+GDB_PATH = os.path.join('data', 'swissBOUNDARIES3D_1_4_LV95_LN02.gdb')
+GDB_LAYER = 'TLM_HOHEITSGEBIET'
+CACHE_DIR = os.path.join('data', 'cache')
+MANIFEST_NAME = 'municipalities.json'
+
+# Columns kept in the artifact and the CRS they are stored in
+COLUMNS = ['BFS_NUMMER', 'NAME', 'KANTONSNUMMER']
+TARGET_CRS = 'EPSG:4326'
+
+# Simplification tolerance in metres of every level of detail; level 0 is the
+# full-resolution survey geometry
+LOD_TOLERANCES = [0, 5, 20, 80, 320]
+
+# Bump when the layout of the artifact changes
+CACHE_FORMAT = 2
+
+# Rows per Parquet row group; rows are sorted by BFS number so that the row
+# group statistics allow filters on BFS_NUMMER to skip whole groups
+ROW_GROUP_SIZE = 128
+
+# The base layer and its levels of detail are loaded in parallel; only one of them builds the artifact
+_build_lock = threading.Lock()
+
+# BFS number ranges of the German-speaking municipalities
+BFS_RANGES = [
+    (1, 299), (301, 999), (1001, 1199), (1201, 1299), (1301, 1399), (1401, 1499),
+    (1501, 1599), (1601, 1699), (1701, 1999), (2401, 2699), (2701, 2759),
+    (2761, 2899), (2901, 2999), (3001, 3099), (3101, 3199), (3201, 3499),
+    (3501, 3999), (4001, 4399), (4401, 4999),
+]
+
+def _source_files(gdb_path):
+    """Return the sorted list of files that make up a geodatabase."""
+    files = []
+    for root, _, names in os.walk(gdb_path):
+        files.extend(os.path.join(root, name) for name in names)
+    return sorted(files)
+
+def _source_stats(gdb_path):
+    """Return (name, mtime, size) for every file of the geodatabase."""
+    stats = []
+    for path in _source_files(gdb_path):
+        stat = os.stat(path)
+        stats.append([os.path.relpath(path, gdb_path), stat.st_mtime_ns, stat.st_size])
+    return stats
+
+def hash_geodatabase(gdb_path=GDB_PATH):
+    """Return a SHA-256 content hash over every file of the geodatabase."""
+    digest = hashlib.sha256()
+    for path in _source_files(gdb_path):
+        digest.update(os.path.relpath(path, gdb_path).encode('utf-8'))
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def _read_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_manifest(cache_dir, manifest):
+    path = os.path.join(cache_dir, MANIFEST_NAME)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+def source_hash(gdb_path=GDB_PATH, cache_dir=CACHE_DIR):
+    """Return the content hash of the geodatabase, rehashing only if its files changed."""
+    stats = _source_stats(gdb_path)
+    manifest = _read_manifest(cache_dir)
+    if manifest.get('source_stats') == stats and manifest.get('source_hash'):
+        return manifest['source_hash']
+    return hash_geodatabase(gdb_path)
+
+def artifact_path(digest, cache_dir=CACHE_DIR):
+    """Return the path of the GeoParquet artifact built from a geodatabase with this hash."""
+    return os.path.join(cache_dir, f"municipalities_{digest[:16]}_v{CACHE_FORMAT}.parquet")
+
+def lod_column(level):
+    """Return the name of the geometry column holding a level of detail."""
+    return 'geometry' if level == 0 else f"geometry_lod{level}"
+
+def lod_for_resolution(metres_per_pixel):
+    """Return the coarsest level of detail whose tolerance stays below one pixel."""
+    level = 0
+    for candidate, tolerance in enumerate(LOD_TOLERANCES):
+        if tolerance <= metres_per_pixel:
+            level = candidate
+    return level
+
+def lod_for_zoom(zoom, latitude=46.8):
+    """Return the level of detail to use for a web map zoom level."""
+    metres_per_pixel = 156543.03 * math.cos(math.radians(latitude)) / 2 ** zoom
+    return lod_for_resolution(metres_per_pixel)
+
+def read_german_municipalities(gdb_path=GDB_PATH):
+    """Read the German-speaking Swiss municipalities straight from the geodatabase."""
+    municipalities = gpd.read_file(
+        gdb_path,
+        layer=GDB_LAYER,
+        columns=COLUMNS + ['ICC'],
+        where="ICC = 'CH'",
+    )
+    swiss_municipalities = municipalities[municipalities['ICC'] == 'CH']
+
+    # Filter for German-speaking municipalities
+    german_filter = False
+    for start, end in BFS_RANGES:
+        german_filter = german_filter | ((swiss_municipalities['BFS_NUMMER'] >= start) &
+                                         (swiss_municipalities['BFS_NUMMER'] <= end))
+
+    # Apply the filter to get German-speaking municipalities
+    german_municipalities = swiss_municipalities[german_filter].copy()
+
+    # Keep only the needed columns
+    return german_municipalities[COLUMNS + ['geometry']].copy()
+
+def build_boundary_cache(gdb_path=GDB_PATH, cache_dir=CACHE_DIR, force=False):
+    """Write the filtered, column-pruned and reprojected municipality set to GeoParquet."""
+    os.makedirs(cache_dir, exist_ok=True)
+    digest = hash_geodatabase(gdb_path)
+    path = artifact_path(digest, cache_dir)
+
+    if force or not os.path.exists(path):
+        print(f"Building municipality cache from {gdb_path}")
+        with stage('gdb_read'):
+            municipalities = read_german_municipalities(gdb_path)
+        record_size('gdb_read', 'rows', len(municipalities))
+
+        # Drop the Z dimension and reproject once, here, instead of on every load
+        geometries = shapely.force_2d(municipalities.geometry.values)
+        municipalities['geometry'] = geometries
+
+        # Simplify the municipalities as one coverage so shared borders stay shared
+        for level, tolerance in enumerate(LOD_TOLERANCES[1:], start=1):
+            simplified = gpd.GeoSeries(shapely.coverage_simplify(geometries, tolerance),
+                                       index=municipalities.index, crs=municipalities.crs)
+            municipalities[lod_column(level)] = simplified.to_crs(TARGET_CRS)
+        municipalities = municipalities.to_crs(TARGET_CRS)
+        municipalities['BFS_NUMMER'] = municipalities['BFS_NUMMER'].astype('int32')
+        municipalities['KANTONSNUMMER'] = municipalities['KANTONSNUMMER'].astype('int32')
+        municipalities = municipalities.sort_values('BFS_NUMMER').reset_index(drop=True)
+
+        # Several workers may build the artifact at once; each writes its own file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        municipalities.to_parquet(tmp_path, index=False, row_group_size=ROW_GROUP_SIZE)
+        os.replace(tmp_path, path)
+        print(f"Wrote {len(municipalities)} municipalities to {path}")
+
+    # Remove artifacts of older geodatabase versions
+    for name in os.listdir(cache_dir):
+        if name.startswith('municipalities_') and name.endswith('.parquet'):
+            stale_path = os.path.join(cache_dir, name)
+            if stale_path != path:
+                try:
+                    os.remove(stale_path)
+                except FileNotFoundError:
+                    pass
+
+    _write_manifest(cache_dir, {
+        'source': gdb_path,
+        'source_hash': digest,
+        'source_stats': _source_stats(gdb_path),
+        'artifact': os.path.basename(path),
+    })
+    return path
+
+def read_boundary_cache(path, columns=None, bfs_numbers=None, level=0):
+    """Read the municipality artifact, pushing column, level and BFS number filters down to Parquet."""
+    geometry_column = lod_column(level)
+    if columns is None:
+        columns = COLUMNS
+    columns = list(dict.fromkeys(list(columns) + [geometry_column]))
+    filters = None
+    if bfs_numbers is not None:
+        filters = [('BFS_NUMMER', 'in', [int(number) for number in bfs_numbers])]
+    with stage('boundary_read', level=level):
+        municipalities = gpd.read_parquet(path, columns=columns, filters=filters)
+    record_size('boundary_read', 'rows', len(municipalities), level=level)
+    municipalities = municipalities.set_geometry(geometry_column)
+    if geometry_column != 'geometry':
+        municipalities = municipalities.rename_geometry('geometry')
+    return municipalities
+
+def load_boundaries(gdb_path=GDB_PATH, cache_dir=CACHE_DIR, columns=None, bfs_numbers=None, level=0):
+    """Load the German-speaking municipalities from the artifact, building it first if needed."""
+    path = artifact_path(source_hash(gdb_path, cache_dir), cache_dir)
+    if not os.path.exists(path):
+        with _build_lock:
+            # Another loader may have built it while this one waited
+            if not os.path.exists(path):
+                path = build_boundary_cache(gdb_path, cache_dir)
+    return read_boundary_cache(path, columns=columns, bfs_numbers=bfs_numbers, level=level)
+
+if __name__ == '__main__':
+    build_boundary_cache(force='--force' in sys.argv[1:])
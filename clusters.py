@@ -0,0 +1,198 @@
+# clusters.py - server-side point clustering per zoom level, served by viewport
+#
+# Instead of sending every point to the browser and clustering there, each point
+# layer is aggregated once per dataset version into a hierarchy of grid cells in
+# Web Mercator pixel space. A cell is CLUSTER_RADIUS pixels wide at its zoom, so
+# every cell splits into exactly four cells one zoom further in: the finest level
+# is built from the points, every coarser level by summing its children. A query
+# returns the cells of one zoom inside the viewport, a few hundred features with
+# counts and attribute means; a cell holding a single point is sent as that point.
+import math
+
+import folium
+import numpy as np
+from jinja2 import Template
+
+from datasets import get_dataset, register_dataset
+from layers import coordinate_decimals
+from metrics import record_size, stage
+from proximity import PROXIMITY_LAYERS, get_point_index
+from scoring import SEGMENT_KEYS
+
+# Cell width in screen pixels and the zoom above which points are no longer merged
+CLUSTER_RADIUS = 64
+MAX_CLUSTER_ZOOM = 16
+
+# Numeric properties averaged over the points of a cluster
+CLUSTER_SUMMARIES = {
+    'competitors': ['rating'],
+}
+
+# Display name and colour of the point layers drawn on the maps
+MAP_LAYERS = {
+    'hotspots': ("Public Hotspots", 'red'),
+    'publicity': ("Publicity Locations", 'green'),
+    'competitors': ("Competitors", 'purple'),
+}
+
+# Point layers drawn on the map of each segment: those whose density weighs at
+# least 0.15 either way in the segment's score
+SEGMENT_POINT_LAYERS = {
+    'kmu': ['hotspots', 'competitors'],
+    'handwerk': ['competitors'],
+    'retail_gastro': ['hotspots', 'publicity', 'competitors'],
+    'service': ['hotspots', 'competitors'],
+    'tourism': ['hotspots', 'publicity'],
+    'startup': ['hotspots', 'publicity'],
+}
+
+CLUSTER_SCRIPT_URL = '/static/js/clusters.js'
+
+# Web Mercator is undefined at the poles
+MAX_LATITUDE = 85.0511
+
+def mercator_pixels(lonlat):
+    """Return the Web Mercator pixel coordinates of (N, 2) lon/lat degrees at zoom 0."""
+    lat = np.radians(np.clip(lonlat[:, 1], -MAX_LATITUDE, MAX_LATITUDE))
+    x = (lonlat[:, 0] + 180.0) / 360.0 * 256
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / math.pi) / 2 * 256
+    return x, y
+
+def build_cluster_index(name):
+    """Aggregate a point layer into grid cells for every zoom from MAX_CLUSTER_ZOOM down to 0."""
+    index = get_point_index(name)
+    lonlat = index['wgs84']
+    summaries = CLUSTER_SUMMARIES.get(name, [])
+    values = np.array([[props.get(column) for column in summaries] for props in index['properties']],
+                      dtype=float).reshape(len(lonlat), len(summaries))
+
+    # The finest level starts from the points themselves, one per cell
+    x, y = mercator_pixels(lonlat)
+    scale = 2 ** MAX_CLUSTER_ZOOM / CLUSTER_RADIUS
+    cells = {
+        'cx': np.floor(x * scale).astype(np.int64),
+        'cy': np.floor(y * scale).astype(np.int64),
+        'count': np.ones(len(lonlat)),
+        'lon_sum': lonlat[:, 0].copy(),
+        'lat_sum': lonlat[:, 1].copy(),
+        'value_sum': np.nan_to_num(values),
+        'value_count': (~np.isnan(values)).astype(float),
+        'point': np.arange(len(lonlat)),
+    }
+
+    levels = {}
+    for zoom in range(MAX_CLUSTER_ZOOM, -1, -1):
+        # Merge the cells that share a grid position at this zoom
+        keys = (cells['cx'] << 32) | cells['cy']
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        size = len(first)
+
+        def total(column):
+            return np.bincount(inverse, weights=column, minlength=size)
+
+        def total_columns(matrix):
+            result = np.zeros((size, matrix.shape[1]))
+            for i, column in enumerate(matrix.T):
+                result[:, i] = total(column)
+            return result
+
+        cells = {
+            'cx': cells['cx'][first],
+            'cy': cells['cy'][first],
+            'count': total(cells['count']),
+            'lon_sum': total(cells['lon_sum']),
+            'lat_sum': total(cells['lat_sum']),
+            'value_sum': total_columns(cells['value_sum']),
+            'value_count': total_columns(cells['value_count']),
+            'point': cells['point'][first],
+        }
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = cells['value_sum'] / cells['value_count']
+        levels[zoom] = {
+            'count': cells['count'].astype(np.int64),
+            'lon': cells['lon_sum'] / cells['count'],
+            'lat': cells['lat_sum'] / cells['count'],
+            'means': means,
+            'point': cells['point'],
+        }
+
+        # One zoom out, each cell is half as many pixels from the origin
+        cells['cx'] = cells['cx'] >> 1
+        cells['cy'] = cells['cy'] >> 1
+
+    return {'levels': levels, 'summaries': summaries, 'properties': index['properties']}
+
+def get_cluster_index(name):
+    """Return the cluster hierarchy of a point layer for the current dataset version."""
+    return get_dataset(f"{name}_clusters")
+
+def query_clusters(name, bbox=None, zoom=0):
+    """Return the clusters of a point layer at a zoom level within bbox as a GeoJSON FeatureCollection."""
+    zoom = max(0, min(MAX_CLUSTER_ZOOM, int(zoom)))
+    with stage('cluster_query', layer=name):
+        index = get_cluster_index(name)
+        level = index['levels'][zoom]
+        selected = np.arange(len(level['count']))
+        if bbox is not None:
+            selected = np.flatnonzero((level['lon'] >= bbox[0]) & (level['lat'] >= bbox[1])
+                                      & (level['lon'] <= bbox[2]) & (level['lat'] <= bbox[3]))
+
+        decimals = coordinate_decimals(zoom)
+        features = []
+        for cell in selected.tolist():
+            count = int(level['count'][cell])
+            if count == 1:
+                properties = dict(index['properties'][level['point'][cell]], cluster=False)
+            else:
+                properties = {'cluster': True, 'count': count}
+                for column, mean in zip(index['summaries'], level['means'][cell].tolist()):
+                    properties[column] = None if math.isnan(mean) else round(mean, 2)
+            features.append({
+                'type': 'Feature',
+                'properties': properties,
+                'geometry': {
+                    'type': 'Point',
+                    'coordinates': [round(float(level['lon'][cell]), decimals), round(float(level['lat'][cell]), decimals)],
+                },
+            })
+    record_size('cluster_query', 'features', len(features), layer=name)
+    return {'type': 'FeatureCollection', 'features': features}
+
+# ----- Folium overlays -----
+#
+# A map embeds no points at all: each overlay is an empty feature group that
+# static/js/clusters.js fills from /api/clusters whenever the view changes.
+
+_OVERLAY_TEMPLATE = Template("""
+{% macro script(this, kwargs) %}
+    addServerClusters({{ this._parent.get_name() }}, {{ this._parent._parent.get_name() }},
+                      {{ this.layer|tojson }}, {{ this.color|tojson }});
+{% endmacro %}
+""")
+
+def cluster_overlay(layer, name, color):
+    """Return a feature group that loads the server-side clusters of a layer for the current view."""
+    group = folium.FeatureGroup(name=name)
+    loader = folium.MacroElement()
+    loader._template = _OVERLAY_TEMPLATE
+    loader.layer = layer
+    loader.color = color
+    group.add_child(loader)
+    return group
+
+def segment_point_layers(segment):
+    """Return the point layers drawn on the map of a segment."""
+    if segment not in SEGMENT_KEYS:
+        raise KeyError(f"Unknown segment: {segment}")
+    return SEGMENT_POINT_LAYERS[segment]
+
+def add_cluster_overlays(m, layers):
+    """Add the cluster overlays of the given point layers, and the script that loads them, to a map."""
+    m.get_root().header.add_child(folium.JavascriptLink(CLUSTER_SCRIPT_URL), name='server_clusters')
+    for layer in layers:
+        name, color = MAP_LAYERS[layer]
+        cluster_overlay(layer, name, color).add_to(m)
+
+for _name in PROXIMITY_LAYERS:
+    register_dataset(f"{_name}_clusters", [], lambda name=_name: build_cluster_index(name),
+                     depends_on=[f"{_name}_index"])
@@ -1,11 +1,404 @@
+# data_preparation.py - ingestion of the CSV sources into typed, validated Parquet artifacts
+#
+# Every CSV source is declared below with its columns, their dtypes and the rules
+# its rows must pass. Ingestion streams a source in record batches parsed by
+# pyarrow, converts formatted numbers ("115,286", "X") with vectorized string
+# operations, drops the rows that break a rule, keeps one row per declared key
+# and writes a typed Parquet artifact batch by batch, plus a validation report,
+# to data/cache/prepared/. Only the key columns are held for the whole source.
+# Each artifact records the SHA-256 of the source it was built from; the app
+# only ever reads the artifacts and re-ingests a source when its content changed.
+#
+# Usage: python data_preparation.py [--data-dir data] [--sources income,localities,commercial]
+#                                   [--force] [--strict]
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+DATA_DIR = 'data'
+
+# Bump when the layout of the artifacts changes
+PREPARED_FORMAT = 1
+
+# Rows of each rule violation quoted in the report
+REPORT_SAMPLES = 5
+
+# Bytes of CSV parsed per record batch. The reader reads up to 32 blocks
+# ahead, so this bounds the memory of an ingestion rather than the file size
+BLOCK_SIZE = 2 << 20
+
+# Declared sources. columns maps every column to its final dtype; formatted
+# columns are read as text and parsed as numbers with thousands separators,
+# dates as ISO dates. Rows missing a required column, outside a range or with
+# a value not in allowed are dropped; key rows are deduplicated, keeping the
+# row with the highest value of keep (or the last row of the file).
+SOURCES = {
+    'income': {
+        'file': 'income_by_municipality_utf8.csv',
+        'names': ['id', 'municipality_name', 'population', 'income'],
+        'columns': {'id': 'int64', 'municipality_name': 'string', 'population': 'Int64', 'income': 'float64'},
+        'formatted': ['population', 'income'],
+        'required': ['id', 'municipality_name', 'income'],
+        'ranges': {'population': (0, None), 'income': (0, None)},
+        'key': ['municipality_name'],
+        'keep': 'id',
+    },
+    'localities': {
+        'file': 'alle_deutschschweiz_gemeinden.csv',
+        'columns': {
+            'Ortschaftsname': 'string', 'PLZ': 'int32', 'Zusatzziffer': 'int16', 'Gemeindename': 'string',
+            'BFS-Nr': 'int32', 'Kantonskürzel': 'category', 'Longitude': 'float64', 'Latitude': 'float64',
+            'Sprache': 'category', 'Validity': 'datetime64[ms]',
+        },
+        'dates': ['Validity'],
+        'required': ['Ortschaftsname', 'PLZ', 'Gemeindename', 'BFS-Nr', 'Longitude', 'Latitude'],
+        'ranges': {'Longitude': (5.9, 10.5), 'Latitude': (45.8, 47.9), 'BFS-Nr': (1, 9999)},
+        'allowed': {'Sprache': ['de', 'fr', 'it', 'rm', 'multiple']},
+        # A locality spanning several municipalities is listed once per municipality
+        'key': ['Ortschaftsname', 'PLZ', 'Zusatzziffer', 'BFS-Nr'],
+    },
+    'commercial': {
+        'file': 'commercial_spaces.csv',
+        'columns': {
+            'id': 'int64', 'RELI': 'Int64', 'E_COORD': 'float64', 'N_COORD': 'float64',
+            'BFS-Nr': 'int32', 'GMDE_HISTID': 'Int64',
+        },
+        'required': ['id', 'E_COORD', 'N_COORD', 'BFS-Nr'],
+        # Extent of Switzerland in LV95
+        'ranges': {'E_COORD': (2_480_000, 2_840_000), 'N_COORD': (1_070_000, 1_300_000)},
+        'key': ['id'],
+    },
+}
+
+# Nullable dtypes the columns are read and validated as, before the final cast
+_READ_DTYPES = {'int64': 'Int64', 'int32': 'Int32', 'int16': 'Int16', 'category': 'string'}
+
+# Arrow types the CSV reader parses numeric columns as; other columns are read as text
+_ARROW_TYPES = {'int64': pa.int64(), 'Int64': pa.int64(), 'int32': pa.int64(), 'int16': pa.int64(),
+                'float64': pa.float64()}
+
+# Row number in the source, carried through the first pass to deduplicate in the second
+ROW_COLUMN = '__row'
+
+_locks = {name: threading.Lock() for name in SOURCES}
+
+def source_path(name, data_dir=DATA_DIR):
+    return os.path.join(data_dir, SOURCES[name]['file'])
+
+def prepared_dir(data_dir=DATA_DIR):
+    return os.path.join(data_dir, 'cache', 'prepared')
+
+def artifact_path(name, data_dir=DATA_DIR):
+    """Return the path of the typed Parquet artifact of a source."""
+    return os.path.join(prepared_dir(data_dir), f"{name}_v{PREPARED_FORMAT}.parquet")
+
+def report_path(name, data_dir=DATA_DIR):
+    return os.path.join(prepared_dir(data_dir), f"{name}_v{PREPARED_FORMAT}.report.json")
+
+def hash_file(path):
+    """Return the SHA-256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# ----- Parsing -----
+
+def _read_dtypes(spec):
+    """Return the dtype each column is validated as: text for formatted and date columns, nullable otherwise."""
+    text = set(spec.get('formatted', [])) | set(spec.get('dates', []))
+    return {
+        column: 'string' if column in text else _READ_DTYPES.get(dtype, dtype)
+        for column, dtype in spec['columns'].items()
+    }
+
+def open_source(path, spec, text=False):
+    """Open a CSV source as a stream of record batches of its declared columns, parsed by pyarrow.
+
+    Formatted and date columns are read as text, and so is every column when
+    text is set; otherwise numbers are parsed by the reader itself.
+    """
+    text_columns = set(spec.get('formatted', [])) | set(spec.get('dates', []))
+    column_types = {
+        column: pa.string() if text or column in text_columns else _ARROW_TYPES.get(dtype, pa.string())
+        for column, dtype in spec['columns'].items()
+    }
+    # Named sources have no header row
+    read_options = pacsv.ReadOptions(column_names=spec.get('names'), block_size=BLOCK_SIZE)
+    convert_options = pacsv.ConvertOptions(column_types=column_types, include_columns=list(spec['columns']),
+                                           strings_can_be_null=True)
+    return pacsv.open_csv(path, read_options=read_options, convert_options=convert_options)
+
+def convert_batch(batch, spec, text=False):
+    """Convert a record batch to the validation dtypes; return the frame and the values that failed to convert per column."""
+    df = batch.to_pandas()
+    invalid = {}
+    formatted = spec.get('formatted', [])
+    dates = spec.get('dates', [])
+    for column, dtype in _read_dtypes(spec).items():
+        if column in formatted:
+            # Formatted numbers: drop thousands separators, anything else that is not a number becomes null
+            parsed = df[column].str.replace(',', '', regex=False).str.replace("'", '', regex=False).str.strip()
+            parsed = pd.to_numeric(parsed, errors='coerce').astype(_READ_DTYPES.get(spec['columns'][column], 'float64'))
+        elif column in dates:
+            parsed = pd.to_datetime(df[column], format='%Y-%m-%d', errors='coerce')
+        elif text and dtype != 'string':
+            parsed = pd.to_numeric(df[column].str.strip(), errors='coerce').astype(dtype)
+        else:
+            df[column] = df[column].astype(dtype)
+            continue
+        invalid[column] = int((df[column].notna() & parsed.isna()).sum())
+        df[column] = parsed
+    return df, {column: count for column, count in invalid.items() if count}
+
+# ----- Validation -----
+
+def _samples(df, mask):
+    """Return the first rows selected by mask as JSON-ready dicts, with their row number in the file."""
+    rows = df[mask].head(REPORT_SAMPLES)
+    records = rows.astype(object).where(rows.notna(), None).to_dict('records')
+    return [dict(record, row=int(index)) for index, record in zip(rows.index, records)]
+
+def _add_dropped(dropped, rule, df, mask):
+    """Count the rows selected by mask as dropped by a rule, quoting the first few."""
+    entry = dropped.setdefault(rule, {'rows': 0, 'samples': []})
+    entry['rows'] += int(mask.sum())
+    if len(entry['samples']) < REPORT_SAMPLES:
+        entry['samples'] += _samples(df, mask)[:REPORT_SAMPLES - len(entry['samples'])]
+
+def apply_rules(df, spec, dropped):
+    """Drop the rows of a batch that break a rule, counting them per rule in dropped; return the kept rows."""
+    keep = pd.Series(True, index=df.index)
+
+    def reject(rule, mask):
+        mask = mask.fillna(False).astype(bool) & keep
+        if mask.any():
+            _add_dropped(dropped, rule, df, mask)
+            keep[mask] = False
+
+    for column in spec.get('required', []):
+        reject(f"{column}: missing or invalid", df[column].isna())
+    for column, (low, high) in spec.get('ranges', {}).items():
+        if low is not None:
+            reject(f"{column}: below {low}", df[column] < low)
+        if high is not None:
+            reject(f"{column}: above {high}", df[column] > high)
+    for column, allowed in spec.get('allowed', {}).items():
+        reject(f"{column}: not one of {allowed}", df[column].notna() & ~df[column].isin(allowed))
+    return df[keep]
+
+def deduplicate(keys, spec, rows, dropped):
+    """Return a mask over all rows read that is True for the row kept per key.
+
+    keys holds the key and keep columns of the valid rows, indexed by their row
+    number: the highest keep value wins, or the last row of the file.
+    """
+    ordered = keys.sort_values(spec['keep'], kind='stable') if spec.get('keep') else keys
+    duplicate = ordered.duplicated(spec['key'], keep='last')
+    if duplicate.any():
+        _add_dropped(dropped, f"duplicate {', '.join(spec['key'])}", ordered, duplicate)
+    winners = np.zeros(rows, dtype=bool)
+    winners[ordered.index[~duplicate].to_numpy()] = True
+    return winners
+
+# ----- Artifacts -----
+
+def artifact_schema(spec, digest):
+    """Return the Arrow schema of a source's artifact, recording the hash of the source it was built from."""
+    empty = pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in spec['columns'].items()})
+    schema = pa.Table.from_pandas(empty, preserve_index=False).schema
+    for i, field in enumerate(schema):
+        # Fix the category dictionaries to one type, whatever the categories of a batch
+        if pa.types.is_dictionary(field.type):
+            schema = schema.set(i, pa.field(field.name, pa.dictionary(pa.int32(), pa.string())))
+    return schema.with_metadata({**(schema.metadata or {}), b'source_sha256': digest.encode('ascii')})
+
+def _write_atomic(path, write):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _check_rows(path, spec, rows_path, text):
+    """First pass: stream a source through conversion and the row rules into rows_path.
+
+    Returns the rows read, the invalid values and dropped rows so far, and the
+    key columns of the valid rows; only those stay in memory.
+    """
+    rows_read = 0
+    invalid = {}
+    dropped = {}
+    keys = []
+    key_columns = list(dict.fromkeys(spec.get('key', []) + ([spec['keep']] if spec.get('keep') else [])))
+    writer = None
+    try:
+        for batch in open_source(path, spec, text):
+            df, batch_invalid = convert_batch(batch, spec, text)
+            df.index = pd.RangeIndex(rows_read, rows_read + len(df))
+            rows_read += len(df)
+            for column, count in batch_invalid.items():
+                invalid[column] = invalid.get(column, 0) + count
+
+            df = apply_rules(df, spec, dropped)
+            if key_columns:
+                # A copy, so that the rest of the batch is not kept alive with the keys
+                keys.append(df[key_columns].copy())
+            table = pa.Table.from_pandas(df.rename_axis(ROW_COLUMN).reset_index(), preserve_index=False,
+                                         schema=writer.schema if writer else None)
+            if writer is None:
+                writer = pq.ParquetWriter(rows_path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    keys = pd.concat(keys) if keys else pd.DataFrame(columns=key_columns)
+    return rows_read, invalid, dropped, keys
+
+def prepare_source(name, data_dir=DATA_DIR):
+    """Ingest one source: parse, validate, deduplicate and write its artifact and report; return the report.
+
+    The source is streamed twice in batches, so memory stays bounded by
+    BLOCK_SIZE plus the key columns, whatever the size of the source.
+    """
+    spec = SOURCES[name]
+    path = source_path(name, data_dir)
+    start = time.perf_counter()
+    digest = hash_file(path)
+    os.makedirs(prepared_dir(data_dir), exist_ok=True)
+    artifact = artifact_path(name, data_dir)
+    rows_path = f"{artifact}.{os.getpid()}.{threading.get_ident()}.rows.tmp"
+
+    try:
+        try:
+            rows_read, invalid, dropped, keys = _check_rows(path, spec, rows_path, text=False)
+        except pa.ArrowInvalid:
+            # A value that does not fit its type fails the typed parse: read
+            # everything as text and convert column by column instead
+            rows_read, invalid, dropped, keys = _check_rows(path, spec, rows_path, text=True)
+        winners = deduplicate(keys, spec, rows_read, dropped) if spec.get('key') else None
+
+        # Second pass: keep one row per key and cast to the declared dtypes
+        schema = artifact_schema(spec, digest)
+        rows_written = 0
+
+        def write_artifact(tmp_path):
+            nonlocal rows_written
+            with pq.ParquetWriter(tmp_path, schema, compression='zstd') as writer:
+                if not os.path.exists(rows_path):
+                    return
+                # One row group per first-pass batch; iter_batches() would read ahead across the whole file
+                rows_file = pq.ParquetFile(rows_path)
+                for group in range(rows_file.num_row_groups):
+                    df = rows_file.read_row_group(group).to_pandas()
+                    rows = df.pop(ROW_COLUMN).to_numpy()
+                    if winners is not None:
+                        df = df[winners[rows]]
+                    df = df.astype(spec['columns'])
+                    writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+                    rows_written += len(df)
+        _write_atomic(artifact, write_artifact)
+    finally:
+        if os.path.exists(rows_path):
+            os.remove(rows_path)
+
+    report = {
+        'source': path,
+        'sha256': digest,
+        'artifact': artifact,
+        'prepared': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'seconds': round(time.perf_counter() - start, 3),
+        'rows_read': rows_read,
+        'rows_written': rows_written,
+        'invalid_values': invalid,
+        'dropped': dropped,
+        'columns': dict(spec['columns']),
+    }
+    def write_report(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False, default=str)
+    _write_atomic(report_path(name, data_dir), write_report)
+    print(f"Prepared {name}: {rows_read} rows read, {rows_written} written, "
+          f"{sum(rule['rows'] for rule in dropped.values())} dropped ({report['seconds']:.3f}s)")
+    return report
+
+def _artifact_hash(path):
+    """Return the source hash recorded in an artifact, or None if there is no readable artifact."""
+    try:
+        metadata = pq.read_schema(path).metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return None
+    return metadata.get(b'source_sha256', b'').decode('ascii') or None
+
+def ensure_prepared(name, data_dir=DATA_DIR, force=False):
+    """Return the artifact path of a source, ingesting it first if the source content changed."""
+    path = artifact_path(name, data_dir)
+    with _locks[name]:
+        if force or _artifact_hash(path) != hash_file(source_path(name, data_dir)):
+            prepare_source(name, data_dir)
+    return path
+
+def load_prepared(name, data_dir=DATA_DIR, columns=None):
+    """Load the clean, typed rows of a source."""
+    return pd.read_parquet(ensure_prepared(name, data_dir), columns=columns)
+
+def main():
+    parser = argparse.ArgumentParser(description='Parse, validate and deduplicate the CSV sources into typed Parquet artifacts.')
+    parser.add_argument('--data-dir', default=DATA_DIR, help='source data directory')
+    parser.add_argument('--sources', default=','.join(SOURCES), help='comma-separated sources to prepare')
+    parser.add_argument('--force', action='store_true', help='prepare sources even if they did not change')
+    parser.add_argument('--strict', action='store_true', help='exit with status 1 if any row was dropped')
+    args = parser.parse_args()
+
+    names = args.sources.split(',')
+    unknown = [name for name in names if name not in SOURCES]
+    if unknown:
+        parser.error(f"unknown sources {unknown}, choose from {list(SOURCES)}")
+
+    reports = {}
+    failed = False
+    for name in names:
+        try:
+            ensure_prepared(name, args.data_dir, force=args.force)
+            with open(report_path(name, args.data_dir), encoding='utf-8') as f:
+                reports[name] = json.load(f)
+        except (OSError, ValueError, pa.ArrowException) as e:
+            print(f"Error preparing {name}: {e}")
+            reports[name] = {'error': str(e)}
+            failed = True
+
+    output = os.path.join(prepared_dir(args.data_dir), 'validation_report.json')
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(reports, f, indent=2, ensure_ascii=False)
+
+    for name, report in reports.items():
+        if 'error' in report:
+            continue
+        print(f"{name:<12} {report['rows_read']:>9} read {report['rows_written']:>9} written")
+        for column, count in report['invalid_values'].items():
+            print(f"{'':<12} {count:>9} invalid values in {column}")
+        for rule, details in report['dropped'].items():
+            print(f"{'':<12} {details['rows']:>9} dropped: {rule}")
+    print(f"Wrote {output}")
+
+    dropped_any = any(report.get('dropped') for report in reports.values())
+    if failed or (args.strict and dropped_any):
+        sys.exit(1)
 
-# Inspect the income CSV
-income_df = pd.read_csv('data/income_by_municipality_utf8.csv', header=None)
-income_df.columns = ['id', 'municipality_name', 'population', 'income']
-print("First few rows of income data:")
-print(income_df.head())
-print("\nNon-numeric income values:")
-print(income_df[~income_df['income'].str.replace('.', '', 1).str.isnumeric()]['income'].unique())
-print("\nMissing values:")
-print(income_df.isna().sum())
\ No newline at end of file
+if __name__ == '__main__':
+    main()
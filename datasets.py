@@ -0,0 +1,461 @@
+# datasets.py - data loaders and the process-wide dataset registry
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+import geopandas as gpd
+import pandas as pd
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from boundaries import GDB_PATH, LOD_TOLERANCES, load_boundaries
+from data_preparation import load_prepared
+from matching import best_matches, match_income_names
+from metrics import record_size, stage
+from store import load_stored
+
+# ----- Source files -----
+
+DATA_DIR = 'data'
+INCOME_PATH = os.path.join(DATA_DIR, 'income_by_municipality_utf8.csv')
+HOTSPOTS_PATH = os.path.join(DATA_DIR, 'public_hotspots.geojson')
+PUBLICITY_PATH = os.path.join(DATA_DIR, 'publicity_locations.geojson')
+COMPETITORS_PATH = os.path.join(DATA_DIR, 'competitors.json')
+COMMERCIAL_PATH = os.path.join(DATA_DIR, 'commercial_spaces.csv')
+
+# Characters read per step when streaming a JSON array without ijson
+JSON_CHUNK_SIZE = 1 << 20
+
+# ----- Loaders -----
+
+def load_municipalities(gdb_path=GDB_PATH, level=0):
+    """Load the German-speaking Swiss municipalities from the precompiled boundary cache."""
+    german_municipalities = load_boundaries(gdb_path, level=level)
+    german_municipalities['BFS_NUMMER'] = german_municipalities['BFS_NUMMER'].astype(str)
+    return german_municipalities
+
+def load_income(municipalities):
+    """Load income data and match it to municipalities by BFS number, falling back to name matching.
+
+    Returns the BFS_NUMMER, income and income_normalized columns, or None if the
+    income data could not be loaded.
+    """
+    try:
+        # Load the typed, validated income rows; data_preparation.py already
+        # dropped the non-numeric incomes and kept one row per municipality name
+        with stage('income_read'):
+            income_df = load_prepared('income', DATA_DIR)
+        record_size('income_read', 'rows', len(income_df))
+
+        # Log basic statistics for debugging
+        print(f"Income data loaded: {len(income_df)} rows")
+        print(f"Income range: min={income_df['income'].min()}, max={income_df['income'].max()}")
+
+        # Normalize income for coloring (scale between 0 and 1)
+        income_min = income_df['income'].min()
+        income_max = income_df['income'].max()
+        income_df['income_normalized'] = (
+            (income_df['income'] - income_min) / (income_max - income_min)
+            if income_max != income_min else 0
+        )
+
+        # Log normalization results
+        print(f"Normalized income range: min={income_df['income_normalized'].min()}, max={income_df['income_normalized'].max()}")
+
+        # Match income rows to municipalities: exact BFS/name joins first, batch fuzzy matching for the rest
+        with stage('income_matching'):
+            matches = best_matches(match_income_names(income_df, municipalities, 'BFS_NUMMER', 'NAME'))
+        record_size('income_matching', 'rows', len(matches))
+        income_df = income_df.merge(matches[['income_id', 'bfs_number']], left_on='id', right_on='income_id')
+        income_df['BFS_NUMMER'] = income_df['bfs_number'].astype(str)
+        return income_df[['BFS_NUMMER', 'income', 'income_normalized']].reset_index(drop=True)
+
+    except Exception as e:
+        print(f"Error loading or merging income data: {e}")
+        return None
+
+def merge_income(municipalities, income):
+    """Join the matched income columns onto the municipalities, which keep their shared geometry."""
+    if income is None:
+        return municipalities
+
+    # Merge with municipalities GeoDataFrame using the matched BFS numbers
+    with stage('income_merge'):
+        merged = municipalities.merge(income, on='BFS_NUMMER', how='left')
+
+    # Log merge results
+    missing_income = merged[merged['income'].isna()]
+    if not missing_income.empty:
+        print(f"Warning: {len(missing_income)} municipalities have no income data: {missing_income['NAME'].tolist()}")
+
+    return merged
+
+def load_and_merge_income_data(municipalities):
+    """Load income data and merge it with municipalities by BFS number, falling back to name matching."""
+    return merge_income(municipalities, load_income(municipalities))
+
+def get_municipality_layer(level=0):
+    """Return the municipalities with income data and the geometry of the given level of detail."""
+    municipalities = get_dataset('municipality_income')
+    if level == 0:
+        return municipalities
+    simplified = get_dataset(f"municipalities_lod{level}").set_index('BFS_NUMMER').geometry
+    geometry = gpd.GeoSeries(municipalities['BFS_NUMMER'].map(simplified).values,
+                             index=municipalities.index, crs=simplified.crs)
+    return municipalities.set_geometry(geometry)
+
+def load_hotspots():
+    """Load public hotspot locations"""
+    hotspots = gpd.read_file(HOTSPOTS_PATH)
+    return hotspots
+
+def load_publicity_locations():
+    """Load publicity/advertising locations"""
+    publicity = gpd.read_file(PUBLICITY_PATH)
+    return publicity
+
+def iter_json_array(path, chunk_size=JSON_CHUNK_SIZE):
+    """Yield the elements of a top-level JSON array one by one, reading the file incrementally."""
+    if ijson is not None:
+        with open(path, 'rb') as f:
+            yield from ijson.items(f, 'item', use_float=True)
+        return
+
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8-sig') as f:
+        buffer = ''
+        while not buffer:
+            chunk = f.read(chunk_size)
+            buffer = chunk.lstrip()
+            if not chunk:
+                break
+        if not buffer.startswith('['):
+            raise ValueError(f"{path} does not contain a JSON array")
+        position = 1
+        eof = False
+        while True:
+            # Skip the whitespace and comma before the next element
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) and buffer[position] == ']':
+                return
+
+            # Decode the next element; an element cut off by the end of the
+            # buffer fails to decode, or decodes to a prefix of itself for a
+            # number (12 of 12.5), so it is only complete once the ',' or ']'
+            # after it has been read
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+                following = end
+                while following < len(buffer) and buffer[following] in ' \t\r\n':
+                    following += 1
+                complete = following < len(buffer) and buffer[following] in ',]'
+                if not complete and eof:
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buffer, following)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                chunk = f.read(chunk_size)
+                buffer = buffer[position:] + chunk
+                position = 0
+                eof = not chunk
+                continue
+            yield item
+            position = end
+
+def load_competitors():
+    """Stream competitor locations from the Places-style JSON export into columns, one row per place id"""
+    names, addresses, place_ids = [], [], []
+    latitudes, longitudes, ratings = array('d'), array('d'), array('d')
+
+    # Type lists are stored as a categorical: every distinct combination once
+    type_codes, type_categories = array('i'), {}
+
+    seen = set()
+    duplicates = 0
+    for comp in iter_json_array(COMPETITORS_PATH):
+        place_id = comp.get('place_id')
+        if place_id is not None:
+            if place_id in seen:
+                duplicates += 1
+                continue
+            seen.add(place_id)
+
+        location = comp['geometry']['location']
+        latitudes.append(location['lat'])
+        longitudes.append(location['lng'])
+        rating = comp.get('rating')
+        ratings.append(math.nan if rating is None else rating)
+        names.append(comp.get('name'))
+        addresses.append(comp.get('formatted_address'))
+        place_ids.append(place_id)
+        type_codes.append(type_categories.setdefault(', '.join(comp.get('types', [])), len(type_categories)))
+
+    if duplicates:
+        print(f"Skipped {duplicates} competitors with a duplicate place id")
+
+    # Convert to GeoDataFrame
+    return gpd.GeoDataFrame({
+        'place_id': place_ids,
+        'name': names,
+        'address': addresses,
+        'type': pd.Categorical.from_codes(type_codes, categories=list(type_categories)),
+        'rating': ratings,
+    }, geometry=gpd.points_from_xy(longitudes, latitudes), crs="EPSG:4326")
+
+# ----- Dataset Registry -----
+#
+# Every dataset is loaded once per process and kept in memory. A dataset names
+# the source files its loader reads and the registered datasets it is derived
+# from; its fingerprint combines the content hashes of its own files with the
+# fingerprints of those dependencies. A changed file therefore invalidates
+# exactly the datasets downstream of it, and a file rewritten with the same
+# content invalidates nothing. Request handlers never parse the sources, and
+# a fingerprint is rechecked against the files at most once per WATCH_INTERVAL
+# (the watcher rechecks every loaded dataset on its own schedule), so looking
+# up a loaded dataset does not touch the disk.
+
+FINGERPRINTS_PATH = os.path.join(DATA_DIR, 'cache', 'fingerprints.json')
+
+# Seconds between two checks of the watcher for changed source files
+WATCH_INTERVAL = 10
+
+_sources = {}
+_cache = {}
+_locks = {}
+_load_times = {}
+# Last computed fingerprint of every dataset, with the monotonic time it was computed
+_fingerprints = {}
+_registry_lock = threading.Lock()
+
+# Content hash of every source file seen, reused while its mtime and size stay the same
+_hashes = {'files': None, 'dirty': False}
+_hash_lock = threading.Lock()
+_watcher = None
+
+def register_dataset(name, paths, loader, store=None, depends_on=()):
+    """Register a dataset loader together with the source files it reads.
+
+    depends_on names the registered datasets the loader reads through
+    get_dataset(); they must be registered first, so the registration order
+    is also an order in which every dataset comes after its dependencies.
+    store is 'table' or 'arrays' for datasets that are written once to the
+    shared store and memory-mapped by every other worker.
+    """
+    with _registry_lock:
+        missing = [dependency for dependency in depends_on if dependency not in _sources]
+        if missing:
+            raise KeyError(f"Dataset '{name}' depends on unregistered datasets: {missing}")
+        _sources[name] = {'paths': list(paths), 'depends_on': list(depends_on), 'loader': loader, 'store': store}
+        _locks.setdefault(name, threading.Lock())
+        _cache.pop(name, None)
+        _fingerprints.clear()
+
+def _read_hashes():
+    try:
+        with open(FINGERPRINTS_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_hashes():
+    """Persist the known content hashes, so that restarts and other workers do not rehash unchanged files."""
+    with _hash_lock:
+        if not _hashes['dirty']:
+            return
+        files = dict(_hashes['files'])
+        _hashes['dirty'] = False
+    try:
+        os.makedirs(os.path.dirname(FINGERPRINTS_PATH), exist_ok=True)
+        tmp_path = f"{FINGERPRINTS_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(files, f, indent=2)
+        os.replace(tmp_path, FINGERPRINTS_PATH)
+    except OSError as e:
+        print(f"Error writing source fingerprints: {e}")
+
+def _file_hash(path):
+    """Return the SHA-256 of a file's content, rehashing only if its mtime or size changed."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    with _hash_lock:
+        if _hashes['files'] is None:
+            _hashes['files'] = _read_hashes()
+        known = _hashes['files'].get(path)
+    if known is not None and known[:2] == [stat.st_mtime_ns, stat.st_size]:
+        return known[2]
+
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    with _hash_lock:
+        _hashes['files'][path] = [stat.st_mtime_ns, stat.st_size, digest.hexdigest()]
+        _hashes['dirty'] = True
+    return digest.hexdigest()
+
+def _path_fingerprint(path):
+    """Return (path, content hash) pairs for a file or every file below a directory."""
+    if os.path.isdir(path):
+        entries = []
+        for root, _, files in os.walk(path):
+            for file_name in sorted(files):
+                entries.extend(_path_fingerprint(os.path.join(root, file_name)))
+        return entries
+    return [(path, _file_hash(path))]
+
+def _fingerprint(name, memo):
+    """Return the fingerprint of a dataset, computing each dependency once per call."""
+    if name not in memo:
+        source = _sources[name]
+        own = [entry for path in source['paths'] for entry in _path_fingerprint(path)]
+        dependencies = [(dependency, _fingerprint(dependency, memo)) for dependency in source['depends_on']]
+        memo[name] = hashlib.sha256(repr((own, dependencies)).encode('utf-8')).hexdigest()
+    return memo[name]
+
+def _current_fingerprints(names, max_age=WATCH_INTERVAL):
+    """Return the fingerprints of the given datasets, recomputing those older than max_age seconds."""
+    now = time.monotonic()
+    fingerprints = {}
+    memo = {}
+    for name in names:
+        known = _fingerprints.get(name)
+        if known is not None and now - known[0] < max_age:
+            fingerprints[name] = known[1]
+        else:
+            fingerprints[name] = _fingerprint(name, memo)
+    if memo:
+        _fingerprints.update((name, (now, fingerprint)) for name, fingerprint in memo.items())
+        _write_hashes()
+    return fingerprints
+
+def dataset_fingerprint(name):
+    """Return the content fingerprint of a dataset's own sources and of every dataset it depends on."""
+    return _current_fingerprints([name])[name]
+
+def get_dataset(name):
+    """Return a registered dataset, loading it on first use or when its sources changed."""
+    if name not in _sources:
+        raise KeyError(f"Unknown dataset: {name}")
+
+    fingerprint = dataset_fingerprint(name)
+    cached = _cache.get(name)
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+
+    # Only one thread loads a given dataset, the others wait for its result
+    with _locks[name]:
+        cached = _cache.get(name)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+        print(f"Loading dataset '{name}'")
+        start = time.perf_counter()
+        source = _sources[name]
+        with stage('dataset_load', dataset=name):
+            if source['store'] is None:
+                value = source['loader']()
+            else:
+                key = fingerprint[:16]
+                value = load_stored(source['store'], name, key, source['loader'])
+        _load_times[name] = time.perf_counter() - start
+        if isinstance(value, pd.DataFrame):
+            record_size('dataset_load', 'rows', len(value), dataset=name)
+        _cache[name] = (fingerprint, value)
+        return value
+
+def dataset_version(*names):
+    """Return a short string identifying the loaded state of the given datasets."""
+    names = names or tuple(sorted(_sources))
+    fingerprints = _current_fingerprints(names)
+    fingerprints = repr([fingerprints[name] for name in names])
+    return hashlib.sha1(fingerprints.encode('utf-8')).hexdigest()[:12]
+
+def preload_datasets(*names, workers=8):
+    """Load the given datasets (or all registered ones) concurrently and report per-dataset timings.
+
+    Datasets that read other datasets wait on their per-name lock, so shared
+    sources are loaded once no matter which worker reaches them first.
+    """
+    names = names or tuple(_sources)
+    errors = {}
+
+    def preload(name):
+        try:
+            get_dataset(name)
+        except Exception as e:
+            print(f"Error preloading dataset '{name}': {e}")
+            errors[name] = str(e)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='preload') as pool:
+        list(pool.map(preload, names))
+    elapsed = time.perf_counter() - start
+
+    # Loader times include the datasets a loader reads itself
+    report = {}
+    for name in names:
+        report[name] = {'seconds': round(_load_times.get(name, 0.0), 3)}
+        if name in errors:
+            report[name]['error'] = errors[name]
+        print(f"  {name:<28} {report[name]['seconds']:>8.3f}s{' (failed)' if name in errors else ''}")
+    print(f"Preloaded {len(names)} datasets in {elapsed:.3f}s")
+    return report
+
+def stale_datasets():
+    """Return the loaded datasets whose fingerprint changed since they were loaded, in registration order."""
+    fingerprints = _current_fingerprints([name for name in _sources if name in _cache], max_age=0)
+    return [name for name in fingerprints if _cache[name][0] != fingerprints[name]]
+
+def refresh_datasets():
+    """Reload only the loaded datasets downstream of a changed source file; return their names."""
+    stale = stale_datasets()
+    if stale:
+        print(f"Source files changed, refreshing {len(stale)} datasets: {', '.join(stale)}")
+        preload_datasets(*stale)
+    return stale
+
+def start_watcher(interval=WATCH_INTERVAL):
+    """Start a daemon thread that refreshes the datasets whose sources changed, once per process."""
+    global _watcher
+
+    def watch():
+        while True:
+            time.sleep(interval)
+            try:
+                refresh_datasets()
+            except Exception as e:
+                print(f"Error refreshing datasets: {e}")
+
+    with _registry_lock:
+        if _watcher is None:
+            _watcher = threading.Thread(target=watch, name='dataset-watcher', daemon=True)
+            _watcher.start()
+    return _watcher
+
+register_dataset('municipalities', [GDB_PATH], load_municipalities, store='table')
+for _level in range(1, len(LOD_TOLERANCES)):
+    register_dataset(f"municipalities_lod{_level}", [GDB_PATH],
+                     lambda level=_level: load_municipalities(level=level), store='table')
+# Only the income columns are stored; the geometry is shared with 'municipalities'
+register_dataset('income', [INCOME_PATH], lambda: load_income(get_dataset('municipalities')), store='table',
+                 depends_on=['municipalities'])
+register_dataset('municipality_income', [], lambda: merge_income(get_dataset('municipalities'), get_dataset('income')),
+                 depends_on=['municipalities', 'income'])
+register_dataset('hotspots', [HOTSPOTS_PATH], load_hotspots, store='table')
+register_dataset('publicity', [PUBLICITY_PATH], load_publicity_locations, store='table')
+register_dataset('competitors', [COMPETITORS_PATH], load_competitors, store='table')
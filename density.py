@@ -0,0 +1,179 @@
+# density.py - server-side kernel density rasters and PNG map tiles
+#
+# Point layers are binned onto a fixed LV95 grid covering Switzerland and
+# smoothed with a separable Gaussian kernel, convolved along each axis with
+# NumPy's FFT. The cost depends on the grid size, not on the number of points.
+# One raster is cached per layer and per segment weighting (for the current
+# dataset version) and served as XYZ PNG tiles, so the browser draws one image
+# layer instead of thousands of circle markers.
+import functools
+import io
+import math
+import threading
+
+import numpy as np
+from PIL import Image
+
+from datasets import dataset_version
+from metrics import stage
+from projection import LV95, WGS84, get_coordinates, get_transformer
+from scoring import FEATURES, SEGMENT_KEYS, SEGMENT_WEIGHTS
+
+# LV95 extent of Switzerland and the raster resolution
+GRID_BOUNDS = (2480000.0, 1070000.0, 2840000.0, 1300000.0)
+CELL_SIZE = 250.0
+
+# Standard deviation of the Gaussian kernel in metres
+BANDWIDTH = 1500.0
+
+TILE_SIZE = 256
+
+# Point layers and the feature column they correspond to in the scoring matrix
+DENSITY_LAYERS = {
+    'hotspots': 'hotspot_density',
+    'publicity': 'publicity_density',
+    'competitors': 'competitor_density',
+    'commercial': 'commercial_density',
+}
+
+# Yellow to dark red, as in the legend of index.html
+COLOR_STOPS = np.array([[0xFF, 0xED, 0xA0], [0xFD, 0x8D, 0x3C], [0xBD, 0x00, 0x26]], dtype=float)
+
+_rasters = {}
+_lock = threading.RLock()
+
+def grid_shape(bounds=GRID_BOUNDS, cell_size=CELL_SIZE):
+    """Return the (rows, columns) of the raster grid."""
+    min_e, min_n, max_e, max_n = bounds
+    return int(math.ceil((max_n - min_n) / cell_size)), int(math.ceil((max_e - min_e) / cell_size))
+
+def rasterize(coordinates, bounds=GRID_BOUNDS, cell_size=CELL_SIZE, weights=None):
+    """Count LV95 points per grid cell; row 0 is the northern edge."""
+    rows, columns = grid_shape(bounds, cell_size)
+    min_e, _, _, max_n = bounds
+    coordinates = np.asarray(coordinates, dtype=float)
+    column = np.floor((coordinates[:, 0] - min_e) / cell_size)
+    row = np.floor((max_n - coordinates[:, 1]) / cell_size)
+    inside = (column >= 0) & (column < columns) & (row >= 0) & (row < rows)
+    cells = row[inside].astype(np.int64) * columns + column[inside].astype(np.int64)
+    counts = np.bincount(cells, weights=None if weights is None else weights[inside],
+                         minlength=rows * columns)
+    return counts.reshape(rows, columns).astype(float)
+
+def gaussian_kernel(sigma):
+    """Return a normalized 1D Gaussian kernel with a radius of four sigma."""
+    radius = max(1, int(math.ceil(4 * sigma)))
+    x = np.arange(-radius, radius + 1, dtype=float)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+def _convolve_axis(grid, kernel, axis):
+    """Convolve every line of grid along one axis with kernel, using the FFT."""
+    length = grid.shape[axis]
+    size = 1 << int(math.ceil(math.log2(length + len(kernel) - 1)))
+    spectrum = np.fft.rfft(grid, n=size, axis=axis)
+    kernel_shape = [1, 1]
+    kernel_shape[axis] = -1
+    spectrum *= np.fft.rfft(kernel, n=size).reshape(kernel_shape)
+    full = np.fft.irfft(spectrum, n=size, axis=axis)
+    start = len(kernel) // 2
+    return np.take(full, np.arange(start, start + length), axis=axis)
+
+def gaussian_smooth(grid, sigma):
+    """Smooth a raster with a separable Gaussian of sigma cells."""
+    kernel = gaussian_kernel(sigma)
+    smoothed = _convolve_axis(_convolve_axis(grid, kernel, 0), kernel, 1)
+    return np.maximum(smoothed, 0)
+
+def _layer_coordinates(layer):
+    coordinates = get_coordinates(layer)['lv95']
+    return coordinates[~np.isnan(coordinates).any(axis=1)]
+
+def density_datasets(name):
+    """Return the datasets the density raster of a layer or segment is built from."""
+    if name in DENSITY_LAYERS:
+        return (f"{name}_coordinates",)
+    return tuple(f"{layer}_coordinates" for layer in DENSITY_LAYERS)
+
+def _build_raster(name):
+    """Build the normalized density raster of a layer or of a segment weighting."""
+    if name in DENSITY_LAYERS:
+        raster = gaussian_smooth(rasterize(_layer_coordinates(name)), BANDWIDTH / CELL_SIZE)
+    else:
+        # A segment raster combines the layer rasters with the segment's positive weights
+        weights = SEGMENT_WEIGHTS[SEGMENT_KEYS.index(name)]
+        raster = np.zeros(grid_shape())
+        for layer, feature in DENSITY_LAYERS.items():
+            weight = weights[FEATURES.index(feature)]
+            if weight > 0:
+                raster += weight * get_raster(layer)
+    peak = raster.max()
+    return (raster / peak if peak > 0 else raster).astype(np.float32)
+
+def density_names():
+    """Return every name a density raster can be requested for."""
+    return list(DENSITY_LAYERS) + SEGMENT_KEYS
+
+def density_version(name):
+    """Return the version of the data a density raster is built from."""
+    return dataset_version(*density_datasets(name))
+
+def get_raster(name):
+    """Return the cached density raster of a layer or segment, rebuilt when the data changed."""
+    version = density_version(name)
+    cached = _rasters.get(name)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with _lock:
+        cached = _rasters.get(name)
+        if cached is None or cached[0] != version:
+            with stage('density_raster', raster=name):
+                cached = (version, _build_raster(name))
+            _rasters[name] = cached
+    return cached[1]
+
+def _tile_lv95_coordinates(z, x, y):
+    """Return the LV95 coordinates of the centres of all pixels of a web map tile."""
+    offsets = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    n = 2 ** z
+    lon = (x + offsets) / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + offsets) / n))))
+    lon_grid, lat_grid = np.meshgrid(lon, lat)
+    e, n_coord = get_transformer(WGS84, LV95).transform(lon_grid.ravel(), lat_grid.ravel())
+    return e.reshape(TILE_SIZE, TILE_SIZE), n_coord.reshape(TILE_SIZE, TILE_SIZE)
+
+def colorize(values):
+    """Map values in [0, 1] to RGBA pixels with the legend's color ramp."""
+    values = np.clip(values, 0, 1)
+    position = values * (len(COLOR_STOPS) - 1)
+    lower = np.minimum(position.astype(int), len(COLOR_STOPS) - 2)
+    fraction = (position - lower)[..., None]
+    rgb = COLOR_STOPS[lower] * (1 - fraction) + COLOR_STOPS[lower + 1] * fraction
+    alpha = np.where(values < 0.02, 0, np.minimum(1, values * 1.5) * 200)
+    return np.dstack([rgb, alpha]).astype(np.uint8)
+
+@functools.lru_cache(maxsize=2048)
+def _render_tile(name, version, z, x, y):
+    raster = get_raster(name)
+    rows, columns = raster.shape
+    min_e, _, _, max_n = GRID_BOUNDS
+    e, n = _tile_lv95_coordinates(z, x, y)
+    column = np.floor((e - min_e) / CELL_SIZE).astype(np.int64)
+    row = np.floor((max_n - n) / CELL_SIZE).astype(np.int64)
+    inside = (column >= 0) & (column < columns) & (row >= 0) & (row < rows)
+    values = np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.float32)
+    values[inside] = raster[row[inside], column[inside]]
+
+    # Square root stretch so that sparse areas stay visible next to the cities
+    buffer = io.BytesIO()
+    with stage('density_tile_encode'):
+        Image.fromarray(colorize(np.sqrt(values)), 'RGBA').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def render_tile(name, z, x, y):
+    """Return the PNG bytes of one XYZ tile of a density raster."""
+    if name not in density_names():
+        raise KeyError(f"Unknown density layer: {name}")
+    if not (0 <= z <= 20 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise ValueError(f"Invalid tile: {z}/{x}/{y}")
+    return _render_tile(name, density_version(name), z, x, y)
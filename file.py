@@ -1,33 +1,27 @@
 # main.py - Flask application for the geomarketing platform
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, jsonify
 import geopandas as gpd
-import pandas as pd
-import json
+import html
 import folium
-from folium.plugins import HeatMap, MarkerCluster
+from folium.plugins import FastMarkerCluster
 import numpy as np
 import os
-from shapely.geometry import Point
-from fuzzywuzzy import process
-import pandas as pd
+
+from data_preparation import load_prepared
+from datasets import get_dataset
+from matching import best_matches, match_income_names
+from metrics import record_size, stage
+from projection import marker_positions
+from scoring import top_municipalities
 
 app = Flask(__name__)
 
 def load_and_merge_income_data(municipalities):
-    """Load income data and merge with municipalities using fuzzy matching, ignoring invalid income values."""
+    """Load income data and merge with municipalities by BFS number or name, ignoring invalid income values."""
     try:
-        # Load income data
-        income_df = pd.read_csv('data/income_by_municipality_utf8.csv', header=None)
-        income_df.columns = ['id', 'municipality_name', 'population', 'income']
-        
-        # Clean income data: remove quotes and commas
-        income_df['income'] = income_df['income'].str.replace('"', '').str.replace(',', '')
-        
-        # Filter out rows where income is non-numeric (e.g., 'X')
-        income_df = income_df[income_df['income'].str.replace('.', '', 1).str.isnumeric()]
-        
-        # Convert income to float
-        income_df['income'] = income_df['income'].astype(float)
+        # Load the typed, validated income rows; data_preparation.py already
+        # dropped the non-numeric incomes (e.g., 'X')
+        income_df = load_prepared('income')
         
         # Normalize income for coloring (scale between 0 and 1)
         income_min = income_df['income'].min()
@@ -37,17 +31,15 @@ def load_and_merge_income_data(municipalities):
             if income_max != income_min else 0
         )
         
-        # Fuzzy matching to align municipality names
-        municipality_names = municipalities['Gemeindename'].tolist()
-        income_df['matched_name'] = income_df['municipality_name'].apply(
-            lambda x: process.extractOne(x, municipality_names)[0] if pd.notna(x) else None
-        )
-        
+        # Match income rows to municipalities: exact BFS/name joins first, batch fuzzy matching for the rest
+        matches = best_matches(match_income_names(income_df, municipalities, 'BFS-Nr', 'Gemeindename'))
+        income_df = income_df.merge(matches[['income_id', 'bfs_number']], left_on='id', right_on='income_id')
+        income_df['BFS-Nr'] = income_df['bfs_number'].astype(str)
+
         # Merge with municipalities GeoDataFrame
         merged = municipalities.merge(
-            income_df[['matched_name', 'income', 'income_normalized']],
-            left_on='Gemeindename',
-            right_on='matched_name',
+            income_df[['BFS-Nr', 'income', 'income_normalized']],
+            on='BFS-Nr',
             how='left'
         )
         
@@ -58,36 +50,81 @@ def load_and_merge_income_data(municipalities):
         # Return municipalities without income data to prevent map failure
         return municipalities
 
-def load_hotspots():
-    """Load public hotspot locations"""
-    hotspots = gpd.read_file('data/public_hotspots.geojson')
-    return hotspots
-
-def load_publicity_locations():
-    """Load publicity/advertising locations"""
-    publicity = gpd.read_file('data/publicity_locations.geojson')
-    return publicity
-
-def load_competitors():
-    """Load competitor locations from JSON file"""
-    with open('data/competitors.json') as f:
-        competitors = json.load(f)
-    
-    # Convert to GeoDataFrame
-    competitor_list = []
-    for comp in competitors:
-        competitor_list.append({
-            'name': comp['name'],
-            'address': comp['formatted_address'],
-            'type': ', '.join(comp['types']),
-            'rating': comp.get('rating', None),
-            'geometry': Point(comp['geometry']['location']['lng'], 
-                             comp['geometry']['location']['lat'])
-        })
-    
-    return gpd.GeoDataFrame(competitor_list, crs="EPSG:4326")
-
 # ----- Visualization Functions -----
+#
+# Marker layers are emitted as one GeoJSON FeatureCollection (or one
+# FastMarkerCluster data array) per layer instead of one folium object per row.
+# Marker positions come from the pre-projected coordinate arrays when given.
+
+def _records(df):
+    """Return JSON-ready row dicts with missing values as None."""
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+def _positions(gdf, coordinates):
+    """Return WGS84 marker positions and the mask of rows that have one."""
+    if coordinates is None:
+        coordinates = marker_positions(gdf)['wgs84']
+    return coordinates, ~np.isnan(coordinates).any(axis=1)
+
+def point_feature_collection(gdf, properties, defaults=None, coordinates=None):
+    """Return a FeatureCollection of marker points carrying the given property columns."""
+    coordinates, valid = _positions(gdf, coordinates)
+    values = gdf.reindex(columns=properties)[valid]
+    if defaults:
+        values = values.fillna(defaults)
+    records = _records(values)
+    return {
+        'type': 'FeatureCollection',
+        'features': [
+            {'type': 'Feature', 'properties': props, 'geometry': {'type': 'Point', 'coordinates': coords}}
+            for props, coords in zip(records, coordinates[valid].tolist())
+        ],
+    }
+
+def marker_layer(gdf, name, color, popup_fields, popup_aliases=None, popup_defaults=None,
+                 properties=None, style_function=None, coordinates=None):
+    """Return a single GeoJson layer drawing every row of gdf as a circle marker."""
+    with stage('marker_layer', layer=name):
+        collection = point_feature_collection(gdf, properties or popup_fields, popup_defaults, coordinates)
+    record_size('marker_layer', 'features', len(collection['features']), layer=name)
+    return folium.GeoJson(
+        collection,
+        name=name,
+        marker=folium.CircleMarker(radius=5, color=color, fill=True, fill_opacity=0.7),
+        style_function=style_function,
+        popup=folium.GeoJsonPopup(fields=popup_fields, aliases=popup_aliases or [''] * len(popup_fields),
+                                  labels=popup_aliases is not None),
+    )
+
+CLUSTER_CALLBACK = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]),
+                                {radius: 5, color: '%s', fill: true, fillOpacity: 0.7});
+    marker.bindPopup(row[2]);
+    return marker;
+};
+"""
+
+def cluster_layer(gdf, name, color, popup_html, coordinates=None):
+    """Return a FastMarkerCluster layer; popup_html is a Series of popup contents aligned with gdf."""
+    with stage('marker_layer', layer=name):
+        coordinates, valid = _positions(gdf, coordinates)
+        popups = popup_html.astype(str).to_numpy()[valid].tolist()
+        data = [[lat, lon, popup] for (lon, lat), popup in zip(coordinates[valid].tolist(), popups)]
+    record_size('marker_layer', 'features', len(data), layer=name)
+    return FastMarkerCluster(data, callback=CLUSTER_CALLBACK % color, name=name)
+
+def competitor_popups(competitors):
+    """Build the competitor popup HTML for all rows with vectorized string operations."""
+    def escaped(column):
+        return competitors[column].astype(object).fillna('').astype(str).map(html.escape)
+    rating = competitors['rating'].astype(object).where(competitors['rating'].notna(), 'N/A').astype(str)
+    return (
+        '<b>' + escaped('name') + '</b><br>'
+        + 'Address: ' + escaped('address') + '<br>'
+        + 'Type: ' + escaped('type') + '<br>'
+        + 'Rating: ' + rating
+    )
 
 def create_heatmap(data=None, weight_column=None, hotspots=None, publicity=None, competitors=None):
     """Create a base map with German-speaking Swiss municipalities and optional layers."""
@@ -95,19 +132,13 @@ def create_heatmap(data=None, weight_column=None, hotspots=None, publicity=None,
     m = folium.Map(location=[46.8, 8.2], zoom_start=8)
 
     try:
-        # Load municipalities from CSV
-        csv_path = 'data/alle_deutschschweiz_gemeinden.csv'
-        municipalities_df = pd.read_csv(csv_path)
-
-        # Create geometry from Longitude and Latitude
-        municipalities_df['geometry'] = municipalities_df.apply(
-            lambda row: Point(row['Longitude'], row['Latitude']), axis=1
-        )
+        # Load the prepared municipality list
+        municipalities_df = load_prepared('localities')
 
-        # Convert to GeoDataFrame
+        # Create the geometry from Longitude and Latitude in one call
         german_municipalities = gpd.GeoDataFrame(
             municipalities_df,
-            geometry='geometry',
+            geometry=gpd.points_from_xy(municipalities_df['Longitude'], municipalities_df['Latitude']),
             crs='EPSG:4326'
         )
 
@@ -131,95 +162,37 @@ def create_heatmap(data=None, weight_column=None, hotspots=None, publicity=None,
             tooltip_fields.append('income')
             tooltip_aliases.append('Income (CHF):')
 
-        # Add municipalities as CircleMarkers (since CSV provides points)
-        fg_municipalities = folium.FeatureGroup(name="German-Speaking Municipalities")
-        for _, row in german_municipalities.iterrows():
-            if pd.notna(row.geometry):
-                folium.CircleMarker(
-                    location=[row.geometry.y, row.geometry.x],
-                    radius=5,
-                    color='#3388ff',
-                    fill=True,
-                    fill_color=(
-                        '#FF0000' if pd.notna(row.get('income_normalized')) else '#D3D3D3'
-                    ),
-                    fill_opacity=(
-                        row['income_normalized'] * 0.7 + 0.2
-                        if pd.notna(row.get('income_normalized')) else 0.2
-                    ),
-                    weight=1,
-                    popup=folium.Popup(
-                        f"""
-                        <b>{row['Gemeindename']}</b><br>
-                        BFS Number: {row['BFS-Nr']}<br>
-                        Canton: {row['Kantonskürzel']}<br>
-                        Income (CHF): {row['income'] if pd.notna(row.get('income')) else 'N/A'}
-                        """,
-                        max_width=250
-                    )
-                ).add_to(fg_municipalities)
-        fg_municipalities.add_to(m)
+        # Add municipalities as CircleMarkers (since CSV provides points), shaded by income
+        marker_layer(
+            german_municipalities,
+            "German-Speaking Municipalities",
+            '#3388ff',
+            popup_fields=['Gemeindename', 'BFS-Nr', 'Kantonskürzel', 'income'],
+            popup_aliases=['Name:', 'BFS Number:', 'Canton:', 'Income (CHF):'],
+            properties=['Gemeindename', 'BFS-Nr', 'Kantonskürzel', 'income', 'income_normalized'],
+            style_function=lambda x: {
+                'fillColor': '#FF0000' if x['properties'].get('income_normalized') is not None else '#D3D3D3',
+                'fillOpacity': (
+                    x['properties']['income_normalized'] * 0.7 + 0.2
+                    if x['properties'].get('income_normalized') is not None else 0.2
+                ),
+                'weight': 1,
+            },
+        ).add_to(m)
 
         # Add hotspots
         if hotspots is not None:
-            fg_hotspots = folium.FeatureGroup(name="Public Hotspots")
-            for _, row in hotspots.iterrows():
-                if row.geometry.geom_type == 'Point':
-                    coords = [row.geometry.y, row.geometry.x]
-                else:
-                    centroid = row.geometry.centroid
-                    coords = [centroid.y, centroid.x]
-                
-                folium.CircleMarker(
-                    location=coords,
-                    radius=5,
-                    color='red',
-                    fill=True,
-                    fill_opacity=0.7,
-                    popup=str(row.get("name", "Hotspot"))
-                ).add_to(fg_hotspots)
-            fg_hotspots.add_to(m)
+            marker_layer(hotspots, "Public Hotspots", 'red', ['name'],
+                         popup_defaults={'name': "Hotspot"}).add_to(m)
 
         # Add publicity locations
         if publicity is not None:
-            fg_publicity = folium.FeatureGroup(name="Publicity Locations")
-            for _, row in publicity.iterrows():
-                if row.geometry.geom_type == 'Point':
-                    coords = [row.geometry.y, row.geometry.x]
-                else:
-                    centroid = row.geometry.centroid
-                    coords = [centroid.y, centroid.x]
-                
-                folium.CircleMarker(
-                    location=coords,
-                    radius=5,
-                    color='green',
-                    fill=True,
-                    fill_opacity=0.7,
-                    popup=str(row.get("name", "Ad Location"))
-                ).add_to(fg_publicity)
-            fg_publicity.add_to(m)
+            marker_layer(publicity, "Publicity Locations", 'green', ['name'],
+                         popup_defaults={'name': "Ad Location"}).add_to(m)
 
         # Add competitor locations
         if competitors is not None:
-            fg_competitors = folium.FeatureGroup(name="Competitors")
-            competitor_cluster = MarkerCluster(name="Competitor Cluster")
-            for _, row in competitors.iterrows():
-                folium.CircleMarker(
-                    location=[row.geometry.y, row.geometry.x],
-                    radius=5,
-                    color='purple',
-                    fill=True,
-                    fill_opacity=0.7,
-                    popup=f"""
-                        <b>{row['name']}</b><br>
-                        Address: {row['address']}<br>
-                        Type: {row['type']}<br>
-                        Rating: {row['rating'] if pd.notna(row['rating']) else 'N/A'}
-                    """
-                ).add_to(competitor_cluster)
-            competitor_cluster.add_to(fg_competitors)
-            fg_competitors.add_to(m)
+            cluster_layer(competitors, "Competitors", 'purple', competitor_popups(competitors)).add_to(m)
 
         # Layer control
         folium.LayerControl().add_to(m)
@@ -241,10 +214,10 @@ def index():
 @app.route('/get_map')
 def get_map():
     """Generate and return map with German-speaking Swiss municipalities"""
-    # Load hotspot and publicity data
-    hotspots = load_hotspots()
-    publicity = load_publicity_locations()
-    competitors = load_competitors()
+    # Hotspots, publicity locations and competitors are loaded once and shared with main.py
+    hotspots = get_dataset('hotspots')
+    publicity = get_dataset('publicity')
+    competitors = get_dataset('competitors')
     
     # Create map with layers
     m = create_heatmap(hotspots=hotspots, publicity=publicity, competitors=competitors)
@@ -259,37 +232,8 @@ def get_map():
 @app.route('/api/statistics')
 def get_statistics():
     """Get statistics for different segments"""
-    # Load all data
-    merged_data = merge_datasets()
-    hotspots = load_hotspots()
-    publicity = load_publicity_locations()
-    
-    # Apply all weightings
-    data = kmu_weighting(merged_data, hotspots, publicity)
-    data = handwerk_weighting(data, hotspots, publicity)
-    data = retail_gastro_weighting(data, hotspots, publicity)
-    data = service_weighting(data, hotspots, publicity)
-    data = tourism_weighting(data, hotspots, publicity)
-    data = startup_weighting(data, hotspots, publicity)
-    
-    # Calculate top 10 municipalities for each segment
-    top_municipalities = {}
-    
-    for segment, column in [
-        ('KMU', 'kmu_weight'),
-        ('Handwerk', 'handwerk_weight'),
-        ('Retail & Gastro', 'retail_gastro_weight'),
-        ('Dienstleistungen', 'service_weight'),
-        ('Tourismus', 'tourism_weight'),
-        ('Startups', 'startup_weight')
-    ]:
-        top = data.sort_values(column, ascending=False).head(10)
-        top_municipalities[segment] = [
-            {'name': row['region_name'], 'weight': float(row[column])} 
-            for _, row in top.iterrows()
-        ]
-    
-    return jsonify(top_municipalities)
+    # The segment scores are computed once per dataset version, as in main.py
+    return jsonify(top_municipalities(get_dataset('segment_features'), k=10))
 
 if __name__ == '__main__':
     # Create required directories
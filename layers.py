@@ -0,0 +1,153 @@
+# layers.py - per-layer GeoJSON queries by bounding box and zoom level
+#
+# Each layer is indexed once per dataset version with an STRtree. A query returns
+# only the features intersecting the requested bounding box, with geometry
+# simplified to the resolution of the zoom level and coordinates rounded to the
+# precision that is visible at that zoom. Municipalities are not simplified per
+# request: they are served from the precomputed level of detail for the zoom.
+import json
+import math
+import threading
+
+import numpy as np
+import shapely
+
+from boundaries import lod_for_zoom
+from datasets import dataset_version, get_dataset, get_municipality_layer
+from metrics import record_size, stage
+from wire import GEOJSON, PACKED_POINTS, TOPOJSON, packed_points, topojson
+
+# Dataset and properties served for every layer
+LAYERS = {
+    'municipalities': {
+        'dataset': 'municipality_income',
+        'properties': ['BFS_NUMMER', 'NAME', 'KANTONSNUMMER', 'income', 'income_normalized'],
+        'lod': True,
+    },
+    'hotspots': {
+        'dataset': 'hotspots',
+        'properties': ['name'],
+    },
+    'publicity': {
+        'dataset': 'publicity',
+        'properties': ['name'],
+    },
+    'competitors': {
+        'dataset': 'competitors',
+        'properties': ['name', 'address', 'type', 'rating'],
+    },
+}
+
+MIN_ZOOM = 0
+MAX_ZOOM = 20
+
+# Simplification tolerance in screen pixels
+PIXEL_TOLERANCE = 0.5
+
+_indexes = {}
+_lock = threading.Lock()
+
+def degrees_per_pixel(zoom):
+    """Return the width of a 256px web map tile pixel in degrees of longitude."""
+    return 360.0 / (256 * 2 ** zoom)
+
+def coordinate_decimals(zoom):
+    """Return the number of decimals needed to place a coordinate within a pixel."""
+    return max(0, min(7, int(math.ceil(-math.log10(degrees_per_pixel(zoom))))))
+
+def parse_bbox(value):
+    """Parse a 'minx,miny,maxx,maxy' string in WGS84 degrees."""
+    parts = [float(part) for part in value.split(',')]
+    if (len(parts) != 4 or not all(math.isfinite(part) for part in parts)
+            or not -180 <= parts[0] <= parts[2] <= 180 or not -90 <= parts[1] <= parts[3] <= 90):
+        raise ValueError(f"Invalid bbox: {value}")
+    return parts
+
+def get_layer_index(layer, level=0):
+    """Return the layer's geometries, properties and STRtree, rebuilding them when the dataset changed."""
+    dataset = LAYERS[layer]['dataset']
+    if LAYERS[layer].get('lod'):
+        version = dataset_version(dataset, *([f"municipalities_lod{level}"] if level else []))
+    else:
+        version = dataset_version(dataset)
+    key = (layer, level)
+    index = _indexes.get(key)
+    if index is not None and index['version'] == version:
+        return index
+
+    with _lock:
+        index = _indexes.get(key)
+        if index is None or index['version'] != version:
+            gdf = get_municipality_layer(level) if LAYERS[layer].get('lod') else get_dataset(dataset)
+            gdf = gdf[gdf.geometry.notna() & ~gdf.geometry.is_empty]
+            if gdf.crs is not None and not gdf.crs.equals('EPSG:4326'):
+                gdf = gdf.to_crs('EPSG:4326')
+            columns = [column for column in LAYERS[layer]['properties'] if column in gdf.columns]
+            geometries = gdf.geometry.values
+            index = {
+                'version': version,
+                'geometries': np.asarray(geometries),
+                'properties': gdf[columns].astype(object).where(gdf[columns].notna(), None),
+                'tree': shapely.STRtree(geometries),
+            }
+            _indexes[key] = index
+    return index
+
+def layer_formats(layer):
+    """Return the media types a layer can be encoded as, the default first."""
+    if LAYERS[layer].get('lod'):
+        return [GEOJSON, TOPOJSON]
+    return [GEOJSON, PACKED_POINTS]
+
+def query_layer(layer, bbox=None, zoom=MAX_ZOOM, format=GEOJSON):
+    """Return a layer restricted to bbox and simplified for zoom, encoded as GeoJSON, TopoJSON or packed points."""
+    with stage('layer_query', layer=layer, format=format):
+        geometries, properties, decimals = _select_features(layer, bbox, zoom)
+        if format == TOPOJSON:
+            body = topojson(geometries, _records(properties), layer, decimals)
+        elif format == PACKED_POINTS:
+            body = packed_points(geometries, properties)
+        else:
+            body = _feature_collection(geometries, properties)
+    record_size('layer_query', 'features', len(geometries), layer=layer)
+    record_size('layer_query', 'bytes', len(body), layer=layer, format=format)
+    return body
+
+def _select_features(layer, bbox, zoom):
+    """Return the geometries, properties and coordinate decimals of the features to send."""
+    zoom = max(MIN_ZOOM, min(MAX_ZOOM, int(zoom)))
+    lod = LAYERS[layer].get('lod', False)
+    index = get_layer_index(layer, lod_for_zoom(zoom) if lod else 0)
+
+    # Select the features intersecting the viewport
+    if bbox is None:
+        selected = np.arange(len(index['geometries']))
+    else:
+        selected = index['tree'].query(shapely.box(*bbox), predicate='intersects')
+        selected.sort()
+    geometries = index['geometries'][selected]
+
+    # Collapse features smaller than a couple of pixels to points, simplify the rest
+    if not lod:
+        pixel = degrees_per_pixel(zoom)
+        bounds = shapely.bounds(geometries)
+        tiny = np.maximum(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1]) < 2 * pixel
+        geometries = np.where(tiny, shapely.centroid(geometries),
+                              shapely.simplify(geometries, pixel * PIXEL_TOLERANCE, preserve_topology=True))
+
+    # Drop coordinate precision that is not visible at this zoom
+    decimals = coordinate_decimals(zoom)
+    geometries = shapely.transform(geometries, lambda coords: np.round(coords, decimals))
+    return geometries, index['properties'].iloc[selected], decimals
+
+def _feature_collection(geometries, properties):
+    """Assemble a GeoJSON FeatureCollection from pre-serialized geometries."""
+    features = [
+        '{"type":"Feature","properties":%s,"geometry":%s}' % (json.dumps(props, default=str), geometry)
+        for props, geometry in zip(properties.to_dict('records'), shapely.to_geojson(geometries))
+    ]
+    return '{"type":"FeatureCollection","features":[%s]}' % ','.join(features)
+
+def _records(df):
+    """Return JSON-ready row dicts with missing values as None."""
+    return df.astype(object).where(df.notna(), None).to_dict('records')
@@ -0,0 +1,105 @@
+# loadtest.py - concurrent request bursts against a running server
+#
+# For every concurrency level, that many client threads are released at the
+# same moment and each sends its share of the requests back to back, the way a
+# crowd of users arrives after a deploy. With single-flight builds and the build
+# process pool, throughput should stay flat as the concurrency grows instead of
+# collapsing under N identical map builds.
+#
+# Usage: python loadtest.py [--url URL] [--concurrency 1,8,32,64] [--requests 200]
+#                           [--segments kmu,tourism] [--timeout 60] [--output FILE]
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+
+DEFAULT_URL = 'http://127.0.0.1:5000/get_map'
+
+def fetch(url, timeout):
+    """Send one GET request; return (status, seconds)."""
+    start = time.perf_counter()
+    request = urllib.request.Request(url, headers={'Accept-Encoding': 'gzip'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, OSError) as e:
+        status = type(e).__name__
+    return status, time.perf_counter() - start
+
+def percentile(values, fraction):
+    """Return the value below which the given fraction of the sorted values lies."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def burst(urls, concurrency, total, timeout):
+    """Release concurrency clients at once, sending total requests over urls round-robin; return the statistics."""
+    results = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(concurrency + 1)
+
+    def client(worker):
+        barrier.wait()
+        for i in range(worker, total, concurrency):
+            result = fetch(urls[i % len(urls)], timeout)
+            with lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=client, args=(worker,), daemon=True) for worker in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(seconds for _, seconds in results)
+    return {
+        'concurrency': concurrency,
+        'requests': len(results),
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(results) / elapsed, 1) if elapsed else None,
+        'median': round(statistics.median(latencies), 4) if latencies else None,
+        'p95': percentile(latencies, 0.95) and round(percentile(latencies, 0.95), 4),
+        'p99': percentile(latencies, 0.99) and round(percentile(latencies, 0.99), 4),
+        'statuses': {str(status): count for status, count in Counter(status for status, _ in results).items()},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Send concurrent request bursts to a running server and report throughput.')
+    parser.add_argument('--url', default=DEFAULT_URL, help='URL to request')
+    parser.add_argument('--concurrency', default='1,8,32,64', help='comma-separated numbers of concurrent clients')
+    parser.add_argument('--requests', type=int, default=200, help='requests per concurrency level')
+    parser.add_argument('--segments', help="comma-separated segments, appended round-robin as ?segment=")
+    parser.add_argument('--timeout', type=float, default=60, help='seconds before a request counts as failed')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    urls = [args.url]
+    if args.segments:
+        separator = '&' if '?' in args.url else '?'
+        urls = [f"{args.url}{separator}segment={segment}" for segment in args.segments.split(',')]
+
+    levels = []
+    print(f"{'clients':>8} {'requests':>9} {'req/s':>9} {'median':>9} {'p95':>9} {'p99':>9}  statuses")
+    for concurrency in [int(level) for level in args.concurrency.split(',')]:
+        level = burst(urls, concurrency, max(args.requests, concurrency), args.timeout)
+        levels.append(level)
+        print(f"{level['concurrency']:>8} {level['requests']:>9} {level['throughput']:>9} "
+              f"{level['median']:>8}s {level['p95']:>8}s {level['p99']:>8}s  {level['statuses']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'urls': urls, 'levels': levels}, f, indent=2)
+        print(f"Wrote {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -1,152 +1,80 @@
 from flask import Flask, render_template, request, jsonify
-import geopandas as gpd
 import pandas as pd
-import json
 import folium
-from folium.plugins import HeatMap, MarkerCluster
-import numpy as np
 import os
-from shapely.geometry import Point
-from fuzzywuzzy import process
-import pandas as pd
+import threading
+import time
+
+from datasets import (
+    dataset_version,
+    get_dataset,
+    get_municipality_layer,
+    preload_datasets,
+    start_watcher,
+)
+from boundaries import LOD_TOLERANCES, lod_for_zoom
+from clusters import add_cluster_overlays, query_clusters, segment_point_layers
+from density import density_datasets, density_names, density_version, get_raster, render_tile
+from layers import (
+    LAYERS,
+    MAX_ZOOM,
+    get_layer_index,
+    layer_formats,
+    parse_bbox,
+    query_layer,
+)
+from map_cache import cached_map_response, get_cached_map, get_latest_map, store_map
+import metrics
+from metrics import record_size, stage
+from prerender import BUILD_TIMEOUT, refresh, run_build, schedule_render, start_refresher
+from wire import GEOJSON, PACKED_POINTS, TOPOJSON
+from proximity import (
+    MAX_K,
+    MAX_LOCATIONS,
+    MAX_RADIUS,
+    PROXIMITY_LAYERS,
+    nearest,
+    score_locations,
+    validate_locations,
+    within_radius,
+)
+from spatial import MAX_MISMATCHES, commercial_mismatches
+from scoring import (
+    FEATURES,
+    MAX_SCENARIOS,
+    MAX_TOP_K,
+    SEGMENT_KEYS,
+    parse_weights,
+    rank_scenarios,
+    segment_score_table,
+    top_municipalities,
+)
 
 app = Flask(__name__)
+metrics.init_app(app)
 
-def load_and_merge_income_data(municipalities):
-    """Load income data and match with municipalities using the last income value for similar names."""
-    try:
-        # Load income data
-        income_df = pd.read_csv('data/income_by_municipality_utf8.csv', header=None)
-        income_df.columns = ['id', 'municipality_name', 'population', 'income']
-        
-        # Clean income data: remove quotes and commas
-        income_df['income'] = income_df['income'].str.replace('"', '').str.replace(',', '')
-        
-        # Log raw income data for debugging
-        print(f"Raw income sample: {income_df['income'].head().tolist()}")
-        
-        # Filter out rows where income is non-numeric
-        income_df = income_df[income_df['income'].str.isnumeric()]
-        
-        # Convert income to float
-        income_df['income'] = income_df['income'].astype(float)
-        
-        # Log basic statistics for debugging
-        print(f"Income data loaded: {len(income_df)} rows")
-        print(f"Income range: min={income_df['income'].min()}, max={income_df['income'].max()}")
-        
-        # Keep only the last row for each municipality name
-        income_df = income_df.sort_values(by=['municipality_name', 'id']).groupby('municipality_name').last().reset_index()
-        
-        # Normalize income for coloring (scale between 0 and 1)
-        income_min = income_df['income'].min()
-        income_max = income_df['income'].max()
-        income_df['income_normalized'] = (
-            (income_df['income'] - income_min) / (income_max - income_min)
-            if income_max != income_min else 0
-        )
-        
-        # Log normalization results
-        print(f"Normalized income range: min={income_df['income_normalized'].min()}, max={income_df['income_normalized'].max()}")
-        
-        # Fuzzy matching to align municipality names
-        municipality_names = municipalities['NAME'].tolist()
-        def match_name(x):
-            if pd.notna(x):
-                match = process.extractOne(x, municipality_names, score_cutoff=80)
-                return match[0] if match else None
-            return None
-        
-        income_df['matched_name'] = income_df['municipality_name'].apply(match_name)
-        
-        # Log matching results
-        unmatched = income_df[income_df['matched_name'].isna()]
-        if not unmatched.empty:
-            print(f"Warning: {len(unmatched)} municipalities could not be matched: {unmatched['municipality_name'].tolist()}")
-        
-        # Merge with municipalities GeoDataFrame using matched names
-        merged = municipalities.merge(
-            income_df[['matched_name', 'income', 'income_normalized']],
-            left_on='NAME',
-            right_on='matched_name',
-            how='left'
-        )
-        
-        # Log merge results
-        missing_income = merged[merged['income'].isna()]
-        if not missing_income.empty:
-            print(f"Warning: {len(missing_income)} municipalities have no income data: {missing_income['NAME'].tolist()}")
-        
-        return merged
-    
-    except Exception as e:
-        print(f"Error loading or merging income data: {e}")
-        return municipalities
-
-def load_hotspots():
-    """Load public hotspot locations"""
-    hotspots = gpd.read_file('data/public_hotspots.geojson')
-    return hotspots
-
-def load_publicity_locations():
-    """Load publicity/advertising locations"""
-    publicity = gpd.read_file('data/publicity_locations.geojson')
-    return publicity
-
-def load_competitors():
-    """Load competitor locations from JSON file"""
-    with open('data/competitors.json') as f:
-        competitors = json.load(f)
-    
-    # Convert to GeoDataFrame
-    competitor_list = []
-    for comp in competitors:
-        competitor_list.append({
-            'name': comp['name'],
-            'address': comp['formatted_address'],
-            'type': ', '.join(comp['types']),
-            'rating': comp.get('rating', None),
-            'geometry': Point(comp['geometry']['location']['lng'], 
-                             comp['geometry']['location']['lat'])
-        })
-    
-    return gpd.GeoDataFrame(competitor_list, crs="EPSG:4326")
+# Names accepted by the format argument of /api/layers
+LAYER_FORMATS = {'geojson': GEOJSON, 'topojson': TOPOJSON, 'points': PACKED_POINTS}
+
+# Level of detail of the municipality polygons embedded in the map; fine enough
+# for zooming in to about 1:50'000 while keeping the HTML small
+MAP_LOD = lod_for_zoom(12)
+
+# Color scale of segment weightings, matching the legend of index.html
+WEIGHT_COLORS = ['#FFEDA0', '#FD8D3C', '#BD0026']
 
 # ----- Visualization Functions -----
 
-def create_heatmap(data=None, weight_column=None, hotspots=None, publicity=None, competitors=None):
+def create_heatmap(data=None, weight_column=None, point_layers=(), density=None, density_version=None):
     """Create a base map with German-speaking Swiss municipalities and optional layers."""
     # Create a base map centered on Switzerland
     m = folium.Map(location=[46.8, 8.2], zoom_start=8)
 
     try:
-        # Load municipalities
-        gdb_path = 'data/swissBOUNDARIES3D_1_4_LV95_LN02.gdb'
-        municipalities = gpd.read_file(gdb_path, layer='TLM_HOHEITSGEBIET')
-        swiss_municipalities = municipalities[municipalities['ICC'] == 'CH']
-
-        # Filter for German-speaking municipalities
-        bfs_ranges = [
-            (1, 299), (301, 999), (1001, 1199), (1201, 1299), (1301, 1399), (1401, 1499), 
-            (1501, 1599), (1601, 1699), (1701, 1999), (2401, 2699), (2701, 2759), 
-            (2761, 2899), (2901, 2999), (3001, 3099), (3101, 3199), (3201, 3499), 
-            (3501, 3999), (4001, 4399), (4401, 4999),
-        ]
-
-        german_filter = False
-        for start, end in bfs_ranges:
-            german_filter = german_filter | ((swiss_municipalities['BFS_NUMMER'] >= start) & 
-                                             (swiss_municipalities['BFS_NUMMER'] <= end))
-
-        # Apply the filter to get German-speaking municipalities
-        german_municipalities = swiss_municipalities[german_filter].copy()
-        
-        # Keep only the needed columns
-        german_municipalities = german_municipalities[['BFS_NUMMER', 'NAME', 'KANTONSNUMMER', 'geometry']].copy()
-        german_municipalities['BFS_NUMMER'] = german_municipalities['BFS_NUMMER'].astype(str)
-
-        # Merge with income data
-        german_municipalities = load_and_merge_income_data(german_municipalities)
+        # Municipalities merged with income data, at the level of detail used for the map
+        with stage('municipality_layer'):
+            german_municipalities = get_municipality_layer(MAP_LOD)
+        record_size('municipality_layer', 'features', len(german_municipalities))
 
         # Define columns for GeoJson based on available data
         geojson_columns = ['BFS_NUMMER', 'NAME', 'KANTONSNUMMER', 'geometry']
@@ -159,30 +87,49 @@ def create_heatmap(data=None, weight_column=None, hotspots=None, publicity=None,
             tooltip_fields.append('income')
             tooltip_aliases.append('Income (CHF):')
 
-        # Add municipalities with income-based coloring
-        folium.GeoJson(
-            german_municipalities[geojson_columns],
-            style_function=lambda x: {
-                'fillColor': (
-                    # Continuous red gradient: light red (#FF9999) to dark red (#8B0000)
-                    '#{:02x}0000'.format(
-                        int(255 - (x['properties']['income_normalized'] * (255 - 139)))  # 139 for #8B0000
-                    ) if pd.notna(x['properties'].get('income_normalized')) else '#D3D3D3'
-                ),
+        # A weighting in [0, 1] per BFS number (a segment's scores) replaces the income coloring
+        weights = None
+        if data is not None and weight_column is not None:
+            german_municipalities = german_municipalities.merge(
+                data[['BFS_NUMMER', weight_column]], on='BFS_NUMMER', how='left')
+            geojson_columns.append(weight_column)
+            tooltip_fields.append(weight_column)
+            tooltip_aliases.append('Weighting:')
+            weights = folium.LinearColormap(colors=WEIGHT_COLORS, vmin=0, vmax=1, caption='Weighting')
+
+        def style(x):
+            if weights is not None:
+                weight = x['properties'].get(weight_column)
+                fill = weights.rgb_hex_str(weight) if pd.notna(weight) else '#D3D3D3'
+            else:
+                # Continuous red gradient: light red (#FF9999) to dark red (#8B0000)
+                fill = '#{:02x}0000'.format(
+                    int(255 - (x['properties']['income_normalized'] * (255 - 139)))  # 139 for #8B0000
+                ) if pd.notna(x['properties'].get('income_normalized')) else '#D3D3D3'
+            return {
+                'fillColor': fill,
                 'fillOpacity': 0.7,  # Fixed opacity for consistency
                 'color': '#3388ff',  # Border color
                 'weight': 1,
-            },
-            name='German-Speaking Municipalities',
-            tooltip=folium.features.GeoJsonTooltip(
-                fields=tooltip_fields,
-                aliases=tooltip_aliases,
-                localize=True
-            )
-        ).add_to(m)
+            }
+
+        # Add municipalities colored by weighting or income
+        with stage('municipality_geojson'):
+            folium.GeoJson(
+                german_municipalities[geojson_columns],
+                style_function=style,
+                name='German-Speaking Municipalities',
+                tooltip=folium.features.GeoJsonTooltip(
+                    fields=tooltip_fields,
+                    aliases=tooltip_aliases,
+                    localize=True
+                )
+            ).add_to(m)
 
         # Add continuous color scale legend
-        if 'income' in german_municipalities.columns:
+        if weights is not None:
+            weights.add_to(m)
+        elif 'income' in german_municipalities.columns:
             income_min = german_municipalities['income'].min()
             income_max = german_municipalities['income'].max()
             colormap = folium.LinearColormap(
@@ -193,66 +140,19 @@ def create_heatmap(data=None, weight_column=None, hotspots=None, publicity=None,
             )
             colormap.add_to(m)
 
-        # Add hotspots
-        if hotspots is not None:
-            fg_hotspots = folium.FeatureGroup(name="Public Hotspots")
-            for _, row in hotspots.iterrows():
-                if row.geometry.geom_type == 'Point':
-                    coords = [row.geometry.y, row.geometry.x]
-                else:
-                    centroid = row.geometry.centroid
-                    coords = [centroid.y, centroid.x]
-                
-                folium.CircleMarker(
-                    location=coords,
-                    radius=5,
-                    color='red',
-                    fill=True,
-                    fill_opacity=0.7,
-                    popup=str(row.get("name", "Hotspot"))
-                ).add_to(fg_hotspots)
-            fg_hotspots.add_to(m)
-
-        # Add publicity locations
-        if publicity is not None:
-            fg_publicity = folium.FeatureGroup(name="Publicity Locations")
-            for _, row in publicity.iterrows():
-                if row.geometry.geom_type == 'Point':
-                    coords = [row.geometry.y, row.geometry.x]
-                else:
-                    centroid = row.geometry.centroid
-                    coords = [centroid.y, centroid.x]
-                
-                folium.CircleMarker(
-                    location=coords,
-                    radius=5,
-                    color='green',
-                    fill=True,
-                    fill_opacity=0.7,
-                    popup=str(row.get("name", "Ad Location"))
-                ).add_to(fg_publicity)
-            fg_publicity.add_to(m)
-
-        # Add competitor locations
-        if competitors is not None:
-            fg_competitors = folium.FeatureGroup(name="Competitors")
-            competitor_cluster = MarkerCluster(name="Competitor Cluster")
-            for _, row in competitors.iterrows():
-                folium.CircleMarker(
-                    location=[row.geometry.y, row.geometry.x],
-                    radius=5,
-                    color='purple',
-                    fill=True,
-                    fill_opacity=0.7,
-                    popup=f"""
-                        <b>{row['name']}</b><br>
-                        Address: {row['address']}<br>
-                        Type: {row['type']}<br>
-                        Rating: {row['rating'] if pd.notna(row['rating']) else 'N/A'}
-                    """
-                ).add_to(competitor_cluster)
-            competitor_cluster.add_to(fg_competitors)
-            fg_competitors.add_to(m)
+        # Hotspots, publicity locations and competitors are clustered on the
+        # server and loaded by the browser for the visible area only
+        add_cluster_overlays(m, point_layers)
+
+        # Kernel density of the point layers, drawn by the browser as one tile layer
+        if density is not None:
+            folium.TileLayer(
+                tiles=f"/tiles/density/{density}/{{z}}/{{x}}/{{y}}.png?v={density_version}",
+                attr='Density',
+                name='Density',
+                overlay=True,
+                opacity=0.8,
+            ).add_to(m)
 
         # Layer control
         folium.LayerControl().add_to(m)
@@ -261,9 +161,64 @@ def create_heatmap(data=None, weight_column=None, hotspots=None, publicity=None,
         print(f"Error loading municipalities from geodatabase: {e}")
         import traceback
         traceback.print_exc()
+        m.incomplete = True
 
     return m
 
+# ----- Warm-up -----
+#
+# A fresh process loads every data source concurrently and builds the derived
+# indexes and the map of every segment before /ready reports it ready, so no
+# request behind a load balancer pays for a cold start.
+
+DEFAULT_SEGMENT = 'kmu'
+
+_warm_up = {'ready': False, 'seconds': None, 'datasets': {}, 'steps': {}}
+_warm_up_lock = threading.Lock()
+_warm_up_thread = None
+
+def warm_up():
+    """Load all datasets in parallel, then build the indexes, rasters and segment maps outside the registry."""
+    start = time.perf_counter()
+    _warm_up['datasets'] = preload_datasets()
+
+    steps = [
+        ('layer_indexes', lambda: [get_layer_index(layer, level)
+                                   for layer in LAYERS
+                                   for level in (range(len(LOD_TOLERANCES)) if LAYERS[layer].get('lod') else [0])]),
+        ('density_rasters', lambda: [get_raster(name) for name in density_names()]),
+        ('segment_maps', lambda: [future.result() for future in refresh(SEGMENT_KEYS, map_version, build_map)]),
+    ]
+    for name, step in steps:
+        step_start = time.perf_counter()
+        try:
+            step()
+            _warm_up['steps'][name] = {'seconds': round(time.perf_counter() - step_start, 3)}
+        except Exception as e:
+            print(f"Error during warm-up step '{name}': {e}")
+            _warm_up['steps'][name] = {'seconds': round(time.perf_counter() - step_start, 3), 'error': str(e)}
+        print(f"  {name:<28} {_warm_up['steps'][name]['seconds']:>8.3f}s")
+
+    # Failed sources are reported above and by /ready, but do not hold the
+    # worker back forever: requests touching them fail the same way later
+    _warm_up['seconds'] = round(time.perf_counter() - start, 3)
+    _warm_up['ready'] = True
+    print(f"Warm-up finished in {_warm_up['seconds']:.3f}s")
+
+    # From now on reload the datasets downstream of a changed source file, and
+    # rebuild the segment maps in the background whenever their data changes
+    start_watcher()
+    start_refresher(SEGMENT_KEYS, map_version, build_map)
+
+def start_warm_up():
+    """Start the warm-up in a background thread, once per process."""
+    global _warm_up_thread
+    with _warm_up_lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(target=warm_up, name='warm-up', daemon=True)
+            _warm_up_thread.start()
+    return _warm_up_thread
+
 # ----- Flask Routes -----
 
 @app.route('/')
@@ -271,62 +226,279 @@ def index():
     """Main page"""
     return render_template('index.html')
 
+def map_version(segment):
+    """Return the version of the data a segment's map is built from"""
+    # Point layers are loaded by the browser, so only the coloring and the density overlay count
+    return dataset_version('municipality_income', 'segment_features', *density_datasets(segment))
+
+def render_map_html(segment):
+    """Build and render a segment's map; return (html, complete). Runs in a build process"""
+    # Color the municipalities by the segment's scores
+    try:
+        scores = segment_score_table(get_dataset('segment_features'), segment)
+    except Exception as e:
+        print(f"Error loading segment scores, coloring by income instead: {e}")
+        scores = None
+
+    # Create map with the segment's point layers and density overlay
+    density = segment if segment in density_names() else None
+    with stage('map_build'):
+        m = create_heatmap(data=scores, weight_column='score', point_layers=segment_point_layers(segment),
+                           density=density, density_version=density and density_version(density))
+    with stage('map_render'):
+        html = m.get_root().render()
+    record_size('map_render', 'bytes', len(html))
+    # A map colored by income because the scores failed is served, but not cached
+    return html, scores is not None and not getattr(m, 'incomplete', False)
+
+def build_map(segment, version):
+    """Build a segment's map in a build process and cache it; return (entry, html), entry None if the build failed"""
+    with stage('map_process_build'):
+        html, complete = run_build(render_map_html, segment)
+
+    # Do not cache a map whose build failed, so that it is built again
+    if not complete:
+        return None, html
+    with stage('map_store'):
+        return store_map(segment, version, html), None
+
+def render_map(segment):
+    """Return (entry, html) for a segment's map, serving the last good rendering while a newer one is built"""
+    version = map_version(segment)
+    entry = get_cached_map(segment, version)
+    if entry is not None:
+        return entry, None
+
+    # The data changed: rebuild in the background and serve the previous rendering meanwhile
+    future = schedule_render(segment, version, build_map)
+    entry = get_latest_map(segment)
+    if entry is not None:
+        return entry, None
+
+    # Nothing was ever rendered for this segment, so wait for the build, up to a deadline
+    try:
+        return future.result(timeout=BUILD_TIMEOUT)
+    except Exception as e:
+        print(f"No map for segment '{segment}' within {BUILD_TIMEOUT}s: {e!r}")
+        return None, None
+
 @app.route('/get_map')
 def get_map():
-    """Generate and return map with German-speaking Swiss municipalities"""
-    # Load hotspot and publicity data
-    hotspots = load_hotspots()
-    publicity = load_publicity_locations()
-    competitors = load_competitors()
-    
-    # Create map with layers
-    m = create_heatmap(hotspots=hotspots, publicity=publicity, competitors=competitors)
-    
-    # Save map to HTML and return it
-    map_path = 'templates/maps/german_municipalities_map.html'
-    os.makedirs('templates/maps', exist_ok=True)
-    m.save(map_path)
-    
-    return render_template('maps/german_municipalities_map.html')
+    """Return the map of a segment, pre-rendered in the background once per dataset version"""
+    segment = request.args.get('segment', DEFAULT_SEGMENT)
+    if segment not in SEGMENT_KEYS:
+        return jsonify({'error': f"Unknown segment: {segment}"}), 404
+    if metrics.profiling():
+        # Profile the build itself, in this process, rather than the wait for a build process
+        html, _ = render_map_html(segment)
+        return html
+    entry, html = render_map(segment)
+    if entry is None and html is None:
+        response = jsonify({'error': f"No map of segment '{segment}' is available yet"})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    if entry is None:
+        return html
+    return cached_map_response(entry)
+
+@app.route('/ready')
+def ready():
+    """Report readiness: 503 until warm-up has finished, then the per-source timings"""
+    # Under a WSGI server the first readiness probe starts the warm-up
+    start_warm_up()
+    return jsonify(_warm_up), 200 if _warm_up['ready'] else 503
+
+@app.route('/api/layers/<layer>')
+def get_layer(layer):
+    """Return the features of one map layer within a bounding box, simplified for a zoom level
+
+    The encoding is negotiated through the Accept header (or ?format=): GeoJSON
+    for every layer, quantized TopoJSON for municipalities and packed binary
+    points for the point layers.
+    """
+    if layer not in LAYERS:
+        return jsonify({'error': f"Unknown layer: {layer}"}), 404
+    try:
+        bbox = parse_bbox(request.args['bbox']) if 'bbox' in request.args else None
+        zoom = int(request.args.get('zoom', MAX_ZOOM))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    formats = layer_formats(layer)
+    if 'format' in request.args:
+        format = LAYER_FORMATS.get(request.args['format'])
+        if format not in formats:
+            return jsonify({'error': f"Unsupported format for {layer}: {request.args['format']}"}), 406
+    else:
+        format = request.accept_mimetypes.best_match(formats, default=formats[0])
+
+    response = app.response_class(query_layer(layer, bbox, zoom, format), mimetype=format)
+    response.headers['Vary'] = 'Accept'
+    return response
+
+@app.route('/api/clusters/<layer>')
+def get_clusters(layer):
+    """Return the point clusters of a layer within a bounding box at a zoom level"""
+    if layer not in PROXIMITY_LAYERS:
+        return jsonify({'error': f"Unknown layer: {layer}"}), 404
+    try:
+        bbox = parse_bbox(request.args['bbox']) if 'bbox' in request.args else None
+        zoom = int(request.args.get('zoom', 0))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify(query_clusters(layer, bbox, zoom))
+
+@app.route('/tiles/density/<name>/<int:z>/<int:x>/<int:y>.png')
+def get_density_tile(name, z, x, y):
+    """Return one PNG tile of the kernel density raster of a layer or segment"""
+    try:
+        tile = render_tile(name, z, x, y)
+    except KeyError as e:
+        return jsonify({'error': str(e.args[0])}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    response = app.response_class(tile, mimetype='image/png')
+    # Tile URLs carry the dataset version, so a tile never changes under its URL
+    if 'v' in request.args:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def _location_args():
+    """Parse the lat and lon query arguments of a proximity query."""
+    lat, lon = validate_locations([[float(request.args['lat']), float(request.args['lon'])]])[0].tolist()
+    return lat, lon
+
+@app.route('/api/nearby/<layer>')
+def get_nearby(layer):
+    """Return the points of a layer within a radius in metres of a location, nearest first"""
+    if layer not in PROXIMITY_LAYERS:
+        return jsonify({'error': f"Unknown layer: {layer}"}), 404
+    try:
+        lat, lon = _location_args()
+        radius = float(request.args.get('radius', 1000))
+    except (KeyError, ValueError) as e:
+        return jsonify({'error': f"Invalid query: {e}"}), 400
+    if not 0 < radius <= MAX_RADIUS:
+        return jsonify({'error': f"radius must be between 0 and {MAX_RADIUS} metres"}), 400
+
+    return jsonify(within_radius(layer, lon, lat, radius))
+
+@app.route('/api/nearest/<layer>')
+def get_nearest(layer):
+    """Return the k points of a layer nearest to a location"""
+    if layer not in PROXIMITY_LAYERS:
+        return jsonify({'error': f"Unknown layer: {layer}"}), 404
+    try:
+        lat, lon = _location_args()
+        k = int(request.args.get('k', 5))
+    except (KeyError, ValueError) as e:
+        return jsonify({'error': f"Invalid query: {e}"}), 400
+    if not 0 < k <= MAX_K:
+        return jsonify({'error': f"k must be between 1 and {MAX_K}"}), 400
+
+    return jsonify(nearest(layer, lon, lat, k))
+
+@app.route('/api/score_locations', methods=['POST'])
+def post_score_locations():
+    """Score a batch of candidate locations, given as [lat, lon] pairs, for a segment"""
+    body = request.get_json(silent=True)
+    if body is None:
+        body = {}
+    if not isinstance(body, dict):
+        return jsonify({'error': "request body must be a JSON object"}), 400
+    locations = body.get('locations')
+    segment = body.get('segment', 'kmu')
+    try:
+        radius = float(body.get('radius', 1000))
+        if not locations or len(locations) > MAX_LOCATIONS or any(len(location) != 2 for location in locations):
+            raise ValueError(f"locations must be a list of 1 to {MAX_LOCATIONS} [lat, lon] pairs")
+        if not 0 < radius <= MAX_RADIUS:
+            raise ValueError(f"radius must be between 0 and {MAX_RADIUS} metres")
+        if segment not in SEGMENT_KEYS:
+            raise ValueError(f"Unknown segment: {segment}")
+        locations = validate_locations(locations)
+        results = score_locations(locations, radius, segment)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify(results)
 
 @app.route('/api/statistics')
 def get_statistics():
-    """Get statistics for different segments"""
-    # Load all data
-    merged_data = merge_datasets()
-    hotspots = load_hotspots()
-    publicity = load_publicity_locations()
-    
-    # Apply all weightings
-    data = kmu_weighting(merged_data, hotspots, publicity)
-    data = handwerk_weighting(data, hotspots, publicity)
-    data = retail_gastro_weighting(data, hotspots, publicity)
-    data = service_weighting(data, hotspots, publicity)
-    data = tourism_weighting(data, hotspots, publicity)
-    data = startup_weighting(data, hotspots, publicity)
-    
-    # Calculate top 10 municipalities for each segment
-    top_municipalities = {}
-    
-    for segment, column in [
-        ('KMU', 'kmu_weight'),
-        ('Handwerk', 'handwerk_weight'),
-        ('Retail & Gastro', 'retail_gastro_weight'),
-        ('Dienstleistungen', 'service_weight'),
-        ('Tourismus', 'tourism_weight'),
-        ('Startups', 'startup_weight')
-    ]:
-        top = data.sort_values(column, ascending=False).head(10)
-        top_municipalities[segment] = [
-            {'name': row['region_name'], 'weight': float(row[column])} 
-            for _, row in top.iterrows()
-        ]
-    
-    return jsonify(top_municipalities)
+    """Get the top 10 municipalities of one segment (?segment=) or of every segment"""
+    segment = request.args.get('segment')
+    if segment is not None and segment not in SEGMENT_KEYS:
+        return jsonify({'error': f"Unknown segment: {segment}"}), 404
+
+    # Feature matrix and segment scores are computed once per dataset version,
+    # so the version identifies the response of a segment
+    version = dataset_version('segment_features')
+    etag = f"{segment or 'all'}-{version}"
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        matrix = get_dataset('segment_features')
+        response = jsonify(top_municipalities(matrix, k=10, segments=segment and [segment]))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/commercial/mismatches')
+def get_commercial_mismatches():
+    """Return the commercial spaces whose stated BFS number disagrees with their location, one page at a time"""
+    try:
+        bfs = int(request.args['bfs']) if 'bfs' in request.args else None
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', MAX_MISMATCHES))
+    except ValueError as e:
+        return jsonify({'error': f"Invalid query: {e}"}), 400
+    if offset < 0 or not 0 < limit <= MAX_MISMATCHES:
+        return jsonify({'error': f"offset must not be negative and limit must be between 1 and {MAX_MISMATCHES}"}), 400
+
+    version = dataset_version('commercial_assignment')
+    etag = f"mismatches-{bfs}-{offset}-{limit}-{version}"
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        total, page = commercial_mismatches(get_dataset('commercial_assignment'), bfs, offset, limit)
+        response = jsonify({'total': total, 'offset': offset, 'mismatches': page.to_dict('records')})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/what_if', methods=['POST'])
+def post_what_if():
+    """Rank the municipalities for custom feature weights, one vector ('weights') or a batch ('scenarios')"""
+    body = request.get_json(silent=True)
+    if body is None:
+        body = {}
+    if not isinstance(body, dict):
+        return jsonify({'error': "request body must be a JSON object"}), 400
+    try:
+        scenarios = body['scenarios'] if 'scenarios' in body else [body.get('weights')]
+        if not isinstance(scenarios, list) or not 0 < len(scenarios) <= MAX_SCENARIOS:
+            raise ValueError(f"scenarios must be a list of 1 to {MAX_SCENARIOS} weight vectors")
+        scenarios = [parse_weights(weights) for weights in scenarios]
+        k = int(body.get('k', 10))
+        if not 0 < k <= MAX_TOP_K:
+            raise ValueError(f"k must be between 1 and {MAX_TOP_K}")
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    version = dataset_version('segment_features')
+    rankings = rank_scenarios(get_dataset('segment_features'), version, scenarios, k)
+    return jsonify({'features': FEATURES, 'version': version, 'rankings': rankings})
 
 if __name__ == '__main__':
-    # Create required directories
-    os.makedirs('templates/maps', exist_ok=True)
-    
+    # Warm up in the background so that /ready can answer meanwhile; with the
+    # debug reloader only the child process that serves requests warms up
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_warm_up()
+
     # Start the application
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,148 @@
+# map_cache.py - cache of rendered map HTML, served with ETag and precompressed bodies
+#
+# Rendered maps are kept in memory, one entry per segment, together with their
+# gzip (and, if the brotli package is installed, brotli) encodings. An entry is
+# valid for one dataset version; a newer version replaces it. Entries are also
+# written to disk atomically so that a restarted worker can serve them without
+# rebuilding the map.
+import gzip
+import hashlib
+import os
+import tempfile
+import threading
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MAP_CACHE_DIR = os.path.join('data', 'cache', 'maps')
+PERSIST_MAPS = True
+
+_entries = {}
+_lock = threading.Lock()
+
+def _make_entry(segment, version, html):
+    """Build a cache entry with the HTML body, its encodings and a strong ETag."""
+    body = html.encode('utf-8') if isinstance(html, str) else html
+    return {
+        'segment': segment,
+        'version': version,
+        'etag': hashlib.sha256(body).hexdigest()[:32],
+        'identity': body,
+        'gzip': gzip.compress(body, compresslevel=6, mtime=0),
+        'br': brotli.compress(body) if brotli is not None else None,
+    }
+
+def _disk_path(segment, version):
+    return os.path.join(MAP_CACHE_DIR, f"{segment}_{version}.html")
+
+def _write_atomic(path, data):
+    """Write to a temporary file in the target directory and rename it into place."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _persist(entry):
+    """Store the rendered HTML on disk and remove older versions of the same segment."""
+    path = _disk_path(entry['segment'], entry['version'])
+    _write_atomic(path, entry['identity'])
+    prefix = f"{entry['segment']}_"
+    for name in os.listdir(MAP_CACHE_DIR):
+        if name.startswith(prefix) and name.endswith('.html') and name != os.path.basename(path):
+            try:
+                os.remove(os.path.join(MAP_CACHE_DIR, name))
+            except OSError:
+                pass
+
+def _load_persisted(segment, version):
+    try:
+        with open(_disk_path(segment, version), 'rb') as f:
+            return _make_entry(segment, version, f.read())
+    except OSError:
+        return None
+
+def get_cached_map(segment, version):
+    """Return the cached entry for a segment if it was rendered from this dataset version."""
+    entry = _entries.get(segment)
+    if entry is not None and entry['version'] == version:
+        return entry
+    if PERSIST_MAPS:
+        entry = _load_persisted(segment, version)
+        if entry is not None:
+            with _lock:
+                _entries[segment] = entry
+            return entry
+    return None
+
+def get_latest_map(segment):
+    """Return the most recent entry for a segment whatever data version it was rendered from."""
+    entry = _entries.get(segment)
+    if entry is not None or not PERSIST_MAPS:
+        return entry
+
+    # After a restart the last rendering is still on disk
+    prefix = f"{segment}_"
+    try:
+        names = [name for name in os.listdir(MAP_CACHE_DIR)
+                 if name.startswith(prefix) and name.endswith('.html')]
+    except OSError:
+        return None
+    if not names:
+        return None
+    name = max(names, key=lambda name: os.path.getmtime(os.path.join(MAP_CACHE_DIR, name)))
+    entry = _load_persisted(segment, name[len(prefix):-len('.html')])
+    if entry is not None:
+        with _lock:
+            _entries.setdefault(segment, entry)
+    return entry
+
+def store_map(segment, version, html):
+    """Add freshly rendered HTML to the cache and return its entry."""
+    entry = _make_entry(segment, version, html)
+    with _lock:
+        _entries[segment] = entry
+    if PERSIST_MAPS:
+        try:
+            _persist(entry)
+        except OSError as e:
+            print(f"Error persisting rendered map for segment '{segment}': {e}")
+    return entry
+
+def clear_map_cache():
+    """Drop all in-memory entries."""
+    with _lock:
+        _entries.clear()
+
+def cached_map_response(entry):
+    """Serve a cache entry, answering conditional requests with 304 Not Modified."""
+    encodings = request.accept_encodings
+    if entry['br'] is not None and encodings['br']:
+        encoding = 'br'
+    elif encodings['gzip']:
+        encoding = 'gzip'
+    else:
+        encoding = None
+
+    # Each encoding is a different representation and gets its own strong ETag
+    etag = entry['etag'] if encoding is None else f"{entry['etag']}-{encoding}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry[encoding or 'identity'], mimetype='text/html')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
@@ -0,0 +1,204 @@
+# matching.py - batch matching of income rows to municipalities
+#
+# The income table is keyed by BFS number, so most rows can be joined exactly.
+# Only the remainder goes through fuzzy name matching, which is done as one
+# vectorized rapidfuzz cdist call instead of a Python loop over extractOne.
+# The resulting match table is persisted and reused until either input changes.
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+from rapidfuzz import fuzz, process, utils
+
+CACHE_DIR = os.path.join('data', 'cache')
+
+# Minimum fuzzy score for a match and the score difference under which two
+# candidates are reported as ambiguous
+SCORE_CUTOFF = 80
+AMBIGUITY_MARGIN = 3
+
+MATCH_COLUMNS = ['income_id', 'municipality_name', 'bfs_number', 'matched_name', 'score', 'method']
+
+def normalize_names(names):
+    """Normalize municipality names for exact comparison."""
+    return (
+        names.astype('string')
+        .str.normalize('NFKC')
+        .str.casefold()
+        .str.replace(r'\s+', ' ', regex=True)
+        .str.strip()
+    )
+
+def _candidates(municipalities, bfs_column, name_column):
+    """Return the unique (BFS number, name) pairs that income rows can be matched to."""
+    candidates = municipalities[[bfs_column, name_column]].dropna().drop_duplicates()
+    candidates = pd.DataFrame({
+        'bfs_number': pd.to_numeric(candidates[bfs_column], errors='coerce'),
+        'matched_name': candidates[name_column].astype(str),
+    }).dropna(subset=['bfs_number'])
+    candidates['bfs_number'] = candidates['bfs_number'].astype('int64')
+    candidates['normalized_name'] = normalize_names(candidates['matched_name'])
+    return candidates.drop_duplicates('bfs_number').reset_index(drop=True)
+
+def _cache_key(income_df, candidates, score_cutoff):
+    """Hash both inputs so that a stored match table is only reused for identical data."""
+    digest = hashlib.sha1()
+    digest.update(pd.util.hash_pandas_object(income_df[['id', 'municipality_name']], index=False).values.tobytes())
+    digest.update(pd.util.hash_pandas_object(candidates[['bfs_number', 'matched_name']], index=False).values.tobytes())
+    digest.update(str(score_cutoff).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+def _fuzzy_match(names, candidates, score_cutoff, ambiguity_margin):
+    """Score all remaining names against all candidates in one batch."""
+    scores = process.cdist(
+        names,
+        candidates['matched_name'].tolist(),
+        scorer=fuzz.WRatio,
+        processor=utils.default_process,
+        dtype=np.uint8,
+        workers=-1,
+    )
+
+    # Best and second-best candidate per row without sorting the whole matrix
+    rows = np.arange(len(names))
+    best = scores.argmax(axis=1)
+    best_score = scores[rows, best]
+    others = scores.copy()
+    others[rows, best] = 0
+    second = others.argmax(axis=1)
+    second_score = others[rows, second]
+
+    matched = best_score >= score_cutoff
+    ambiguous = matched & (best_score.astype(int) - second_score.astype(int) <= ambiguity_margin)
+    return best, best_score, matched, ambiguous, second, second_score
+
+def match_income_names(income_df, municipalities, bfs_column, name_column,
+                       cache_dir=CACHE_DIR, score_cutoff=SCORE_CUTOFF,
+                       ambiguity_margin=AMBIGUITY_MARGIN):
+    """Return a match table mapping every income row to a BFS number, with score and method."""
+    candidates = _candidates(municipalities, bfs_column, name_column)
+    key = _cache_key(income_df, candidates, score_cutoff)
+    table_path = os.path.join(cache_dir, f"income_matches_{key}.parquet")
+    report_path = os.path.join(cache_dir, f"income_matches_{key}.json")
+
+    # Reuse the stored table as long as neither input changed
+    if os.path.exists(table_path):
+        table = pd.read_parquet(table_path)
+        try:
+            with open(report_path) as f:
+                table.attrs['report'] = json.load(f)
+        except (OSError, ValueError):
+            table.attrs['report'] = match_report(table)
+        return table
+
+    table = pd.DataFrame({
+        'income_id': income_df['id'].astype('int64').values,
+        'municipality_name': income_df['municipality_name'].values,
+    })
+    table['normalized_name'] = normalize_names(table['municipality_name']).values
+    table['bfs_number'] = pd.array([pd.NA] * len(table), dtype='Int64')
+    table['matched_name'] = pd.array([pd.NA] * len(table), dtype='string')
+    table['score'] = 0
+    table['method'] = pd.array([pd.NA] * len(table), dtype='string')
+
+    # 1. Exact join on BFS number, confirmed by the normalized name
+    by_bfs = candidates.set_index('bfs_number')
+    same_bfs = table['income_id'].isin(by_bfs.index)
+    candidate_names = table.loc[same_bfs, 'income_id'].map(by_bfs['normalized_name'])
+    exact_bfs = same_bfs.copy()
+    exact_bfs[same_bfs] = (candidate_names == table.loc[same_bfs, 'normalized_name']).fillna(False).values
+    table.loc[exact_bfs, 'bfs_number'] = table.loc[exact_bfs, 'income_id']
+    table.loc[exact_bfs, 'method'] = 'bfs'
+
+    # 2. Exact join on the normalized name, for names that are unique among the candidates
+    unique_names = candidates.drop_duplicates('normalized_name', keep=False).set_index('normalized_name')
+    by_name = table['method'].isna() & table['normalized_name'].isin(unique_names.index)
+    table.loc[by_name, 'bfs_number'] = table.loc[by_name, 'normalized_name'].map(unique_names['bfs_number']).values
+    table.loc[by_name, 'method'] = 'name'
+
+    table.loc[table['method'].notna(), 'score'] = 100
+    table.loc[table['method'].notna(), 'matched_name'] = table.loc[table['method'].notna(), 'bfs_number'].map(
+        by_bfs['matched_name']).values
+
+    # 3. Vectorized fuzzy matching of the remaining names against the remaining municipalities
+    ambiguous_pairs = []
+    remaining = table['method'].isna() & table['municipality_name'].notna()
+    candidates = candidates[~candidates['bfs_number'].isin(table['bfs_number'].dropna())].reset_index(drop=True)
+    if remaining.any() and not candidates.empty:
+        names = table.loc[remaining, 'municipality_name'].astype(str).tolist()
+        best, best_score, matched, ambiguous, second, second_score = _fuzzy_match(
+            names, candidates, score_cutoff, ambiguity_margin)
+
+        rows = table.index[remaining]
+        table.loc[rows, 'score'] = best_score
+        matched_rows = rows[matched]
+        table.loc[matched_rows, 'bfs_number'] = candidates['bfs_number'].values[best[matched]]
+        table.loc[matched_rows, 'matched_name'] = candidates['matched_name'].values[best[matched]]
+        table.loc[matched_rows, 'method'] = 'fuzzy'
+
+        for i in np.flatnonzero(ambiguous):
+            ambiguous_pairs.append({
+                'income_id': int(table.at[rows[i], 'income_id']),
+                'municipality_name': names[i],
+                'best': candidates['matched_name'].iat[best[i]],
+                'best_score': int(best_score[i]),
+                'second': candidates['matched_name'].iat[second[i]],
+                'second_score': int(second_score[i]),
+            })
+
+    table = table[MATCH_COLUMNS]
+    report = match_report(table, ambiguous_pairs)
+
+    # Log matching results
+    print(f"Income name matching: {report['counts']}")
+    if report['unmatched']:
+        print(f"Warning: {len(report['unmatched'])} municipalities could not be matched, see {report_path}")
+    if report['ambiguous'] or report['conflicts']:
+        print(f"Warning: {len(report['ambiguous'])} ambiguous matches and {len(report['conflicts'])} "
+              f"conflicting matches, see {report_path}")
+
+    # Persist the table and its report for later runs
+    os.makedirs(cache_dir, exist_ok=True)
+    suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    table.to_parquet(table_path + suffix, index=False)
+    os.replace(table_path + suffix, table_path)
+    with open(report_path + suffix, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    os.replace(report_path + suffix, report_path)
+
+    table.attrs['report'] = report
+    return table
+
+def match_report(table, ambiguous_pairs=()):
+    """Summarize a match table: matches per method, unmatched names, ambiguous pairs and conflicts."""
+    counts = table['method'].fillna('unmatched').value_counts()
+
+    # BFS numbers claimed by more than one income row
+    matched = table[table['bfs_number'].notna()]
+    claimed = matched[matched['bfs_number'].duplicated(keep=False)]
+    conflicts = [
+        {
+            'bfs_number': int(bfs_number),
+            'income_rows': [
+                {'income_id': int(row.income_id), 'municipality_name': str(row.municipality_name), 'score': int(row.score)}
+                for row in group.itertuples()
+            ],
+        }
+        for bfs_number, group in claimed.groupby('bfs_number')
+    ]
+
+    return {
+        'counts': {method: int(count) for method, count in counts.items()},
+        'unmatched': table.loc[table['method'].isna(), 'municipality_name'].dropna().astype(str).tolist(),
+        'ambiguous': list(ambiguous_pairs),
+        'conflicts': conflicts,
+    }
+
+def best_matches(table):
+    """Keep a single income row per BFS number: the best score, then the last income id."""
+    matched = table[table['bfs_number'].notna()]
+    matched = matched.sort_values(['bfs_number', 'score', 'income_id'])
+    return matched.drop_duplicates('bfs_number', keep='last')
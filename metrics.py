@@ -0,0 +1,154 @@
+# metrics.py - stage timings and sizes as Prometheus histograms, plus per-request profiles
+#
+# Hot paths wrap their stages in stage(), which records the wall time into the
+# stage_duration_seconds histogram, and report what they produced (rows loaded,
+# features emitted, HTML bytes) with record_size(). /metrics renders all
+# histograms in the Prometheus text exposition format. Adding ?profile=1 to a
+# request returns its cProfile statistics instead of the response, when
+# profiling is enabled (debug mode or ENABLE_PROFILING=1).
+import contextlib
+import cProfile
+import io
+import math
+import os
+import pstats
+import threading
+import time
+
+from flask import g, request
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+
+PROFILE_LINES = 60
+
+_HELP = {
+    'stage_duration_seconds': 'Wall time of one stage of loading, matching or rendering.',
+    'stage_output_size': 'Rows, features or bytes produced by one stage.',
+    'http_request_duration_seconds': 'Wall time of HTTP requests by endpoint and status.',
+}
+
+_histograms = {}
+_lock = threading.Lock()
+
+def observe(metric, value, buckets=DURATION_BUCKETS, **labels):
+    """Add one observation to the histogram of a metric and label set."""
+    key = (metric, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            _histograms[key] = histogram
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram['counts'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+@contextlib.contextmanager
+def stage(name, **labels):
+    """Time the enclosed block as one stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('stage_duration_seconds', time.perf_counter() - start, DURATION_BUCKETS, stage=name, **labels)
+
+def record_size(name, unit, value, **labels):
+    """Record how many rows, features or bytes a stage produced."""
+    observe('stage_output_size', value, SIZE_BUCKETS, stage=name, unit=unit, **labels)
+
+def clear_metrics():
+    """Drop all recorded observations."""
+    with _lock:
+        _histograms.clear()
+
+def snapshot_metrics():
+    """Return a copy of all histograms, to be merged into another process with merge_metrics()."""
+    with _lock:
+        return {key: dict(value, counts=list(value['counts'])) for key, value in _histograms.items()}
+
+def merge_metrics(histograms):
+    """Add the histograms recorded by another process, such as a build process, to this process's."""
+    with _lock:
+        for key, other in histograms.items():
+            histogram = _histograms.get(key)
+            if histogram is None:
+                _histograms[key] = dict(other, counts=list(other['counts']))
+                continue
+            histogram['counts'] = [count + added for count, added in zip(histogram['counts'], other['counts'])]
+            histogram['sum'] += other['sum']
+            histogram['count'] += other['count']
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    ]
+    return '{' + ','.join(escaped) + '}'
+
+def _format_number(value):
+    if math.isinf(value):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render_metrics():
+    """Return every histogram in the Prometheus text exposition format."""
+    with _lock:
+        histograms = sorted((key, dict(value, counts=list(value['counts']))) for key, value in _histograms.items())
+
+    lines = []
+    current_metric = None
+    for (metric, labels), histogram in histograms:
+        if metric != current_metric:
+            lines.append(f"# HELP {metric} {_HELP.get(metric, metric)}")
+            lines.append(f"# TYPE {metric} histogram")
+            current_metric = metric
+        for bound, count in zip(histogram['buckets'], histogram['counts']):
+            lines.append(f"{metric}_bucket{_format_labels(labels + (('le', _format_number(bound)),))} {count}")
+        lines.append(f"{metric}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+        lines.append(f"{metric}_sum{_format_labels(labels)} {_format_number(histogram['sum'])}")
+        lines.append(f"{metric}_count{_format_labels(labels)} {histogram['count']}")
+    return '\n'.join(lines) + '\n'
+
+# ----- Flask integration -----
+
+def profiling_enabled(app):
+    """Return whether ?profile=1 may be used on this app."""
+    return app.debug or os.environ.get('ENABLE_PROFILING') == '1'
+
+def profiling():
+    """Return whether the current request is being profiled."""
+    return 'profiler' in g
+
+def init_app(app):
+    """Time every request by endpoint and serve cProfile output for requests with ?profile=1."""
+    @app.before_request
+    def start_request():
+        g.request_start = time.perf_counter()
+        if request.args.get('profile') == '1' and profiling_enabled(app):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def finish_request(response):
+        start = g.pop('request_start', None)
+        if start is not None:
+            observe('http_request_duration_seconds', time.perf_counter() - start, DURATION_BUCKETS,
+                    endpoint=request.endpoint or 'unknown', method=request.method, status=response.status_code)
+
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        profiler.disable()
+        output = io.StringIO()
+        stats = pstats.Stats(profiler, stream=output)
+        stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+        return app.response_class(output.getvalue(), mimetype='text/plain')
+
+    @app.route('/metrics')
+    def metrics():
+        """Return the recorded histograms for Prometheus"""
+        return app.response_class(render_metrics(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,124 @@
+# prerender.py - background rendering of the segment maps, stale-while-revalidate
+#
+# Segment maps are built on a small worker pool, never inside a request: when
+# the data version changes, requests keep getting the last good rendering of
+# their segment while the new one is built. A refresher thread notices data
+# changes on its own, so the maps are usually rebuilt before anyone asks.
+#
+# Builds are single-flight: every request for the same segment and data
+# version waits on the one pending build. The CPU-heavy part of a build runs in
+# a small process pool, so a burst of builds neither holds the GIL of the web
+# worker nor grows beyond BUILD_PROCESSES concurrent builds. The stage timings
+# and sizes a build records in its process are sent back with the result and
+# merged into the histograms of the web worker.
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from map_cache import get_cached_map
+from metrics import clear_metrics, merge_metrics, snapshot_metrics
+
+RENDER_WORKERS = 2
+
+# Processes the builds run in; 0 builds in the render threads of this process
+BUILD_PROCESSES = int(os.environ.get('MAP_BUILD_PROCESSES', RENDER_WORKERS))
+
+# Seconds a request waits for a segment's first build before giving up
+BUILD_TIMEOUT = float(os.environ.get('MAP_BUILD_TIMEOUT', 30))
+
+# Seconds between two checks of the refresher for changed data
+REFRESH_INTERVAL = 5
+
+_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix='prerender')
+_pending = {}
+_lock = threading.Lock()
+_refresher = None
+_processes = None
+
+def _render(render, segment, version):
+    start = time.perf_counter()
+    try:
+        result = render(segment, version)
+    except Exception as e:
+        print(f"Error rendering map for segment '{segment}': {e}")
+        raise
+    print(f"Rendered map for segment '{segment}' in {time.perf_counter() - start:.3f}s")
+    return result
+
+def _build_with_metrics(function, *args):
+    """Run a build in a build process; return its result and the metrics it recorded."""
+    # A build process runs one build at a time, so everything recorded since the reset belongs to this build
+    clear_metrics()
+    return function(*args), snapshot_metrics()
+
+def run_build(function, *args):
+    """Run a CPU-heavy build function in the build process pool and return its result.
+
+    The builders start from a fresh interpreter (forkserver) rather than a fork
+    of this threaded process, and load their datasets from the shared store.
+    """
+    global _processes
+    if BUILD_PROCESSES <= 0:
+        return function(*args)
+    with _lock:
+        if _processes is None:
+            _processes = ProcessPoolExecutor(max_workers=BUILD_PROCESSES,
+                                             mp_context=multiprocessing.get_context('forkserver'))
+        pool = _processes
+    try:
+        result, histograms = pool.submit(_build_with_metrics, function, *args).result()
+    except BrokenProcessPool:
+        # A crashed builder breaks the whole pool; the next build starts a new one
+        with _lock:
+            if _processes is pool:
+                _processes = None
+        raise
+    merge_metrics(histograms)
+    return result
+
+def schedule_render(segment, version, render):
+    """Build a segment map for a data version in the background, once; return the future of render's result."""
+    with _lock:
+        pending = _pending.get(segment)
+        if pending is not None and pending[0] == version:
+            return pending[1]
+        future = _executor.submit(_render, render, segment, version)
+        _pending[segment] = (version, future)
+
+    def finished(_):
+        # A failed or incomplete build is retried by the next request or refresh
+        with _lock:
+            if _pending.get(segment, (None, None))[1] is future:
+                del _pending[segment]
+    future.add_done_callback(finished)
+    return future
+
+def refresh(segments, current_version, render):
+    """Schedule every segment whose map is missing for its current data version; return the futures."""
+    futures = []
+    for segment in segments:
+        version = current_version(segment)
+        if get_cached_map(segment, version) is None:
+            futures.append(schedule_render(segment, version, render))
+    return futures
+
+def start_refresher(segments, current_version, render, interval=REFRESH_INTERVAL):
+    """Start the thread that re-renders a segment's map whenever current_version(segment) changes."""
+    global _refresher
+
+    def run():
+        while True:
+            try:
+                refresh(segments, current_version, render)
+            except Exception as e:
+                print(f"Error refreshing segment maps: {e}")
+            time.sleep(interval)
+
+    with _lock:
+        if _refresher is None:
+            _refresher = threading.Thread(target=run, name='map-refresher', daemon=True)
+            _refresher.start()
+    return _refresher
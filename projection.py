@@ -0,0 +1,82 @@
+# projection.py - coordinate reference systems and pre-projected coordinate arrays
+#
+# The boundary geodatabase and commercial_spaces.csv are in LV95 (EPSG:2056),
+# the OSM exports and competitors in WGS84 (EPSG:4326). Every point layer is
+# converted once per dataset version into two contiguous (N, 2) float64 arrays:
+# LV95 for metric distance and area work and WGS84 for display. Centroids of
+# non-point features are taken in LV95, not in geographic degrees.
+import functools
+
+import numpy as np
+import shapely
+from pyproj import Transformer
+
+from data_preparation import load_prepared
+from datasets import COMMERCIAL_PATH, DATA_DIR, get_dataset, register_dataset
+
+LV95 = 'EPSG:2056'
+WGS84 = 'EPSG:4326'
+
+@functools.lru_cache(maxsize=None)
+def get_transformer(source, target):
+    """Return a cached transformer between two CRS, with x/y (lon/lat) axis order."""
+    return Transformer.from_crs(source, target, always_xy=True)
+
+def transform_coordinates(coordinates, source, target):
+    """Transform an (N, 2) coordinate array and return it as a contiguous array."""
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    if source == target or len(coordinates) == 0:
+        return np.ascontiguousarray(coordinates)
+    x, y = get_transformer(source, target).transform(coordinates[:, 0], coordinates[:, 1])
+    return np.ascontiguousarray(np.column_stack([x, y]))
+
+def to_lv95(coordinates):
+    """Project (N, 2) lon/lat coordinates to LV95."""
+    return transform_coordinates(coordinates, WGS84, LV95)
+
+def to_wgs84(coordinates):
+    """Project (N, 2) LV95 coordinates to lon/lat."""
+    return transform_coordinates(coordinates, LV95, WGS84)
+
+def transform_geometries(geometries, source, target):
+    """Transform a geometry array with a cached transformer."""
+    if source == target:
+        return np.asarray(geometries)
+    return shapely.transform(
+        np.asarray(geometries),
+        lambda coordinates: transform_coordinates(coordinates, source, target),
+    )
+
+def _crs_name(gdf):
+    return f"EPSG:{gdf.crs.to_epsg()}" if gdf.crs is not None else WGS84
+
+def lv95_geometries(gdf):
+    """Return the geometries of a GeoDataFrame projected to LV95."""
+    return transform_geometries(gdf.geometry.values, _crs_name(gdf), LV95)
+
+def marker_positions(gdf):
+    """Return LV95 and WGS84 marker positions for every row: points as-is, LV95 centroids otherwise.
+
+    Rows with a missing or empty geometry get NaN coordinates, so the arrays stay
+    aligned with the rows of gdf.
+    """
+    geometries = lv95_geometries(gdf)
+    is_point = shapely.get_type_id(geometries) == shapely.GeometryType.POINT
+    points = np.where(is_point, geometries, shapely.centroid(geometries))
+    lv95 = np.ascontiguousarray(np.column_stack([shapely.get_x(points), shapely.get_y(points)]))
+    return {'lv95': lv95, 'wgs84': to_wgs84(lv95)}
+
+def load_commercial_coordinates():
+    """Load commercial space positions (LV95 in the source) as coordinate arrays."""
+    commercial = load_prepared('commercial', DATA_DIR, columns=['E_COORD', 'N_COORD'])
+    lv95 = np.ascontiguousarray(commercial[['E_COORD', 'N_COORD']].to_numpy())
+    return {'lv95': lv95, 'wgs84': to_wgs84(lv95)}
+
+def get_coordinates(name):
+    """Return the pre-projected coordinate arrays of a point layer."""
+    return get_dataset(f"{name}_coordinates")
+
+for _name in ('hotspots', 'publicity', 'competitors'):
+    register_dataset(f"{_name}_coordinates", [], lambda name=_name: marker_positions(get_dataset(name)),
+                     store='arrays', depends_on=[_name])
+register_dataset('commercial_coordinates', [COMMERCIAL_PATH], load_commercial_coordinates, store='arrays')
@@ -0,0 +1,156 @@
+# proximity.py - radius, nearest-neighbour and catchment queries over point layers
+#
+# Every point layer is indexed once per dataset version with an STRtree over its
+# LV95 coordinates, so distances are plain metres. Single queries and batches of
+# candidate locations go through the same vectorized tree queries; nothing is
+# rebuilt per request.
+import numpy as np
+import shapely
+
+from datasets import get_dataset, register_dataset
+from layers import LAYERS
+from projection import get_coordinates, to_lv95
+from scoring import FEATURES, SEGMENT_KEYS, SEGMENT_WEIGHTS
+
+# Point layers that can be queried and the density feature they count towards
+PROXIMITY_LAYERS = {
+    'hotspots': 'hotspot_density',
+    'publicity': 'publicity_density',
+    'competitors': 'competitor_density',
+    'commercial': 'commercial_density',
+}
+
+MAX_RADIUS = 50_000
+MAX_K = 1000
+MAX_LOCATIONS = 1000
+
+def build_point_index(name):
+    """Index the LV95 positions of a point layer together with the properties served for it."""
+    coordinates = get_coordinates(name)
+    valid = ~np.isnan(coordinates['lv95']).any(axis=1)
+    rows = np.flatnonzero(valid)
+    lv95 = coordinates['lv95'][valid]
+
+    if name in LAYERS:
+        gdf = get_dataset(LAYERS[name]['dataset'])
+        columns = [column for column in LAYERS[name]['properties'] if column in gdf.columns]
+        properties = gdf[columns].iloc[rows]
+        properties = properties.astype(object).where(properties.notna(), None).to_dict('records')
+    else:
+        properties = [{} for _ in rows]
+
+    return {
+        'rows': rows,
+        'lv95': lv95,
+        'wgs84': coordinates['wgs84'][valid],
+        'properties': properties,
+        'tree': shapely.STRtree(shapely.points(lv95)),
+    }
+
+def get_point_index(name):
+    """Return the point index of a layer for the current dataset version."""
+    return get_dataset(f"{name}_index")
+
+def _results(index, hits, distances):
+    """Return the hits ordered by distance as JSON-ready dicts."""
+    order = np.argsort(distances, kind='stable')
+    hits, distances = hits[order], distances[order]
+    return [
+        dict(index['properties'][hit], index=int(row), distance=round(float(distance), 1), lat=lat, lon=lon)
+        for hit, row, distance, (lon, lat) in zip(
+            hits.tolist(), index['rows'][hits], distances, index['wgs84'][hits].tolist())
+    ]
+
+def _distances(index, hits, point):
+    return np.hypot(*(index['lv95'][hits] - point).T)
+
+def within_radius(name, lon, lat, radius):
+    """Return the points of a layer within radius metres of a WGS84 location, nearest first."""
+    index = get_point_index(name)
+    point = to_lv95([[lon, lat]])[0]
+    hits = index['tree'].query(shapely.points(point), predicate='dwithin', distance=radius)
+    return _results(index, hits, _distances(index, hits, point))
+
+def nearest(name, lon, lat, k=5):
+    """Return the k points of a layer nearest to a WGS84 location."""
+    index = get_point_index(name)
+    k = min(k, len(index['lv95']))
+    if k == 0:
+        return []
+    point = to_lv95([[lon, lat]])[0]
+    geometry = shapely.points(point)
+
+    # Start from the radius that holds k points at the layer's mean density and
+    # widen it until it does, or until it covers the whole layer
+    low, high = index['lv95'].min(axis=0), index['lv95'].max(axis=0)
+    area = max(float(np.prod(high - low)), 1.0)
+    radius = max(np.sqrt(k * area / (len(index['lv95']) * np.pi)), 1.0)
+    limit = np.hypot(*np.maximum(np.abs(low - point), np.abs(high - point)))
+    while True:
+        hits = index['tree'].query(geometry, predicate='dwithin', distance=radius)
+        if len(hits) >= k or radius > limit:
+            break
+        radius *= 2
+
+    distances = _distances(index, hits, point)
+    closest = np.argpartition(distances, k - 1)[:k]
+    return _results(index, hits[closest], distances[closest])
+
+def validate_locations(locations):
+    """Return [lat, lon] pairs as an (N, 2) array; raise ValueError unless each is a finite WGS84 position."""
+    # bool is an int and numeric strings convert to float, so check the types before converting
+    if isinstance(locations, np.ndarray):
+        numeric = locations.dtype.kind in 'iuf'
+    else:
+        numeric = all(isinstance(value, (int, float)) and not isinstance(value, bool)
+                      for location in locations for value in location)
+    if not numeric:
+        raise ValueError("Invalid location: lat and lon must be numbers")
+    locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+    # NaN fails every comparison, so it is rejected along with infinite and out-of-range values
+    valid = (np.abs(locations[:, 0]) <= 90) & (np.abs(locations[:, 1]) <= 180)
+    if not valid.all():
+        lat, lon = locations[np.argmin(valid)].tolist()
+        raise ValueError(f"Invalid location: lat {lat}, lon {lon}; lat must be within -90..90 and lon within -180..180")
+    return locations
+
+def score_locations(locations, radius=1000, segment='kmu'):
+    """Count every layer around each (lat, lon) candidate location and score it for a segment.
+
+    The score is the segment's density weights applied to log1p of the counts
+    within radius, so it ranks candidates the same way the municipality scores
+    rank municipalities.
+    """
+    locations = validate_locations(locations)
+    points = shapely.points(to_lv95(locations[:, ::-1]))
+    weights = SEGMENT_WEIGHTS[SEGMENT_KEYS.index(segment)]
+
+    counts = {}
+    score = np.zeros(len(points))
+    for name, feature in PROXIMITY_LAYERS.items():
+        tree = get_point_index(name)['tree']
+        candidate, _ = tree.query(points, predicate='dwithin', distance=radius)
+        counts[name] = np.bincount(candidate, minlength=len(points))
+        score += weights[FEATURES.index(feature)] * np.log1p(counts[name])
+
+    # Distance to the nearest competitor; equidistant ties report the same distance
+    nearest_competitor = np.full(len(points), np.nan)
+    competitors = get_point_index('competitors')['tree']
+    if len(competitors.geometries):
+        (candidate, _), distances = competitors.query_nearest(points, return_distance=True)
+        nearest_competitor[candidate] = distances
+
+    return [
+        {
+            'lat': lat,
+            'lon': lon,
+            'score': round(float(score[i]), 4),
+            'counts': {name: int(counts[name][i]) for name in PROXIMITY_LAYERS},
+            'nearest_competitor': None if np.isnan(nearest_competitor[i]) else round(float(nearest_competitor[i]), 1),
+        }
+        for i, (lat, lon) in enumerate(locations.tolist())
+    ]
+
+for _name in PROXIMITY_LAYERS:
+    register_dataset(f"{_name}_index", [], lambda name=_name: build_point_index(name),
+                     depends_on=[f"{_name}_coordinates"] + ([LAYERS[_name]['dataset']] if _name in LAYERS else []))
@@ -0,0 +1,175 @@
+# scoring.py - vectorized segment scoring behind /api/statistics
+#
+# All segment weights are computed from one per-municipality feature matrix:
+# income plus hotspot, publicity, competitor and commercial-space density. Every
+# segment is a row of weights over these features, so all six segment scores
+# come out of a single matrix product. What-if scenarios with analyst-supplied
+# weights are scored the same way, a whole batch in one product, and repeated
+# weight vectors are answered from an LRU cache.
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from datasets import get_dataset, register_dataset
+from projection import get_coordinates, lv95_geometries
+from spatial import assign_points, polygon_index
+
+FEATURES = ['income', 'hotspot_density', 'publicity_density', 'competitor_density', 'commercial_density']
+
+# Segment key (as used by index.html), display name and weight per feature;
+# competitor density counts against a municipality
+SEGMENTS = [
+    ('kmu', 'KMU', [0.30, 0.15, 0.10, -0.20, 0.45]),
+    ('handwerk', 'Handwerk', [0.40, 0.05, 0.10, -0.25, 0.20]),
+    ('retail_gastro', 'Retail & Gastro', [0.20, 0.45, 0.20, -0.15, 0.10]),
+    ('service', 'Dienstleistungen', [0.35, 0.15, 0.10, -0.20, 0.30]),
+    ('tourism', 'Tourismus', [0.10, 0.50, 0.30, -0.10, 0.00]),
+    ('startup', 'Startups', [0.20, 0.25, 0.15, -0.10, 0.30]),
+]
+SEGMENT_KEYS = [key for key, _, _ in SEGMENTS]
+SEGMENT_NAMES = [name for _, name, _ in SEGMENTS]
+SEGMENT_WEIGHTS = np.array([weights for _, _, weights in SEGMENTS], dtype=float)
+
+# Limits of one what-if request and the number of rankings kept in the cache
+MAX_SCENARIOS = 1000
+MAX_TOP_K = 100
+RANKING_CACHE_SIZE = 4096
+
+_rankings = OrderedDict()
+_rankings_lock = threading.Lock()
+
+def count_points_in_polygons(tree, n_polygons, coordinates):
+    """Count for every polygon how many of the (N, 2) LV95 points fall inside it."""
+    assigned = assign_points(coordinates[:, 0], coordinates[:, 1], tree)
+    return np.bincount(assigned[assigned >= 0], minlength=n_polygons)
+
+def _commercial_counts(bfs_numbers):
+    """Count commercial spaces per municipality by the polygon they lie in."""
+    counts = get_dataset('commercial_assignment')['counts'].set_index('BFS_NUMMER')['count']
+    return counts.reindex(bfs_numbers.astype('int64'), fill_value=0).to_numpy()
+
+def _scale(values):
+    """Min-max scale every column to [0, 1]; constant columns become 0."""
+    low = np.nanmin(values, axis=0)
+    span = np.nanmax(values, axis=0) - low
+    span[span == 0] = 1
+    return np.nan_to_num((values - low) / span)
+
+def build_feature_matrix():
+    """Build the normalized per-municipality feature matrix and all segment scores."""
+    municipalities = get_dataset('municipality_income')
+    municipalities = municipalities[municipalities.geometry.notna()].reset_index(drop=True)
+    polygons = lv95_geometries(municipalities)
+    area_km2 = shapely.area(polygons) / 1e6
+    tree = polygon_index(polygons)
+
+    counts = np.column_stack([
+        count_points_in_polygons(tree, len(polygons), get_coordinates(name)['lv95'])
+        for name in ('hotspots', 'publicity', 'competitors')
+    ] + [_commercial_counts(municipalities['BFS_NUMMER'])])
+
+    # Densities per km², log-scaled because a few city centres dominate the raw counts
+    densities = np.log1p(counts / np.maximum(area_km2, 1e-6)[:, None])
+    income = municipalities['income'].to_numpy(dtype=float) if 'income' in municipalities else np.full(len(municipalities), np.nan)
+    raw = np.column_stack([income, densities])
+    features = _scale(raw)
+
+    return {
+        'bfs_numbers': municipalities['BFS_NUMMER'].to_numpy(),
+        'names': municipalities['NAME'].to_numpy(),
+        'raw': pd.DataFrame(raw, columns=FEATURES, index=municipalities['BFS_NUMMER']),
+        'features': features,
+        'scores': segment_scores(features),
+    }
+
+def segment_scores(features, weights=SEGMENT_WEIGHTS):
+    """Score every municipality for every segment in one matrix product, scaled to [0, 1]."""
+    return _scale(features @ weights.T)
+
+def top_k(scores, k=10):
+    """Return the row indices of the k highest scores per column, best first."""
+    k = min(k, scores.shape[0])
+    if k == 0:
+        return np.empty((0, scores.shape[1]), dtype=int)
+    candidates = np.argpartition(-scores, k - 1, axis=0)[:k]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=0), axis=0, kind='stable')
+    return np.take_along_axis(candidates, order, axis=0)
+
+def top_municipalities(matrix, k=10, segments=None):
+    """Return the top k municipalities of the given segments (all by default), keyed by segment display name."""
+    columns = [SEGMENT_KEYS.index(segment) for segment in segments] if segments else range(len(SEGMENTS))
+    scores = matrix['scores'][:, columns]
+    best = top_k(scores, k)
+    return {
+        SEGMENT_NAMES[column]: [
+            {'name': str(matrix['names'][row]), 'weight': float(scores[row, i])}
+            for row in best[:, i]
+        ]
+        for i, column in enumerate(columns)
+    }
+
+def segment_score_table(matrix, segment):
+    """Return the BFS number and score in [0, 1] of every municipality for one segment."""
+    return pd.DataFrame({
+        'BFS_NUMMER': matrix['bfs_numbers'].astype(str),
+        'score': matrix['scores'][:, SEGMENT_KEYS.index(segment)],
+    })
+
+def parse_weights(weights):
+    """Return a weight vector as a tuple over FEATURES, from a list or a {feature: weight} dict.
+
+    Features missing from a dict get weight 0.
+    """
+    if isinstance(weights, dict):
+        unknown = set(weights) - set(FEATURES)
+        if unknown:
+            raise ValueError(f"Unknown features: {sorted(unknown)}")
+        weights = [weights.get(feature, 0) for feature in FEATURES]
+    if not isinstance(weights, (list, tuple)) or len(weights) != len(FEATURES):
+        raise ValueError(f"weights must be a list of {len(FEATURES)} numbers or a dict over {FEATURES}")
+    vector = tuple(float(weight) for weight in weights)
+    if not all(np.isfinite(vector)):
+        raise ValueError("weights must be finite")
+    if not any(vector):
+        raise ValueError("weights must not all be zero")
+    return vector
+
+def rank_scenarios(matrix, version, scenarios, k=10):
+    """Return the top k municipalities for every weight vector of scenarios, in order.
+
+    Vectors not in the cache are scored together in one matrix product over
+    the normalized features; version identifies the data of matrix, so a data
+    refresh never serves cached rankings of the old data.
+    """
+    keys = [(version, weights, k) for weights in scenarios]
+    results = {}
+    with _rankings_lock:
+        for key in keys:
+            if key in _rankings:
+                _rankings.move_to_end(key)
+                results[key] = _rankings[key]
+
+    missing = list(dict.fromkeys(key for key in keys if key not in results))
+    if missing:
+        weights = np.array([key[1] for key in missing], dtype=float)
+        scores = _scale(matrix['features'] @ weights.T)
+        best = top_k(scores, k)
+        with _rankings_lock:
+            for column, key in enumerate(missing):
+                results[key] = [
+                    {'bfs_number': str(matrix['bfs_numbers'][row]), 'name': str(matrix['names'][row]),
+                     'score': round(float(scores[row, column]), 4)}
+                    for row in best[:, column]
+                ]
+                _rankings[key] = results[key]
+            while len(_rankings) > RANKING_CACHE_SIZE:
+                _rankings.popitem(last=False)
+
+    return [results[key] for key in keys]
+
+register_dataset('segment_features', [], build_feature_matrix,
+                 depends_on=['municipality_income', 'hotspots_coordinates', 'publicity_coordinates',
+                             'competitors_coordinates', 'commercial_assignment'])
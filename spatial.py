@@ -0,0 +1,137 @@
+# spatial.py - bulk assignment of point records to municipalities
+#
+# Points are never turned into per-row Python objects: coordinates are read in
+# record batches of the prepared Parquet artifact straight into NumPy arrays,
+# converted to shapely points in one call and matched against a prepared
+# STRtree of the municipality polygons. Memory stays bounded by the chunk size,
+# so the same code handles a few thousand commercial spaces or a full building
+# register.
+import hashlib
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+from data_preparation import ensure_prepared
+from datasets import COMMERCIAL_PATH, DATA_DIR, dataset_version, get_dataset, register_dataset
+from projection import lv95_geometries, to_wgs84
+
+CACHE_DIR = os.path.join('data', 'cache')
+CHUNK_SIZE = 250_000
+
+COMMERCIAL_COLUMNS = ['id', 'E_COORD', 'N_COORD', 'BFS-Nr']
+
+# Most mismatching commercial spaces returned by one request
+MAX_MISMATCHES = 1000
+
+def polygon_index(polygons):
+    """Return an STRtree over prepared polygons, ready for repeated point queries."""
+    polygons = np.asarray(polygons)
+    shapely.prepare(polygons)
+    return shapely.STRtree(polygons)
+
+def assign_points(x, y, tree):
+    """Return for every point the index of the polygon containing it, or -1."""
+    points = shapely.points(np.column_stack([x, y]))
+    point_hits, polygon_hits = tree.query(points, predicate='within')
+    assigned = np.full(len(points), -1, dtype=np.int64)
+    # Points on a shared border keep the first polygon found
+    assigned[point_hits[::-1]] = polygon_hits[::-1]
+    return assigned
+
+def _cache_paths(key, cache_dir):
+    base = os.path.join(cache_dir, f"commercial_{key}")
+    return base + '_counts.parquet', base + '_mismatches.parquet'
+
+def assign_commercial_spaces(data_dir=DATA_DIR, chunk_size=CHUNK_SIZE, cache_dir=CACHE_DIR):
+    """Assign commercial spaces to municipalities by geometry, with counts, densities and BFS mismatches."""
+    municipalities = get_dataset('municipalities')
+    municipalities = municipalities[municipalities.geometry.notna()].reset_index(drop=True)
+    bfs_numbers = municipalities['BFS_NUMMER'].astype('int64').to_numpy()
+
+    # Reuse stored results while neither the points nor the boundaries changed
+    path = ensure_prepared('commercial', data_dir)
+    stat = os.stat(path)
+    key = hashlib.sha1(repr((os.path.abspath(path), stat.st_mtime_ns, stat.st_size,
+                             dataset_version('municipalities'))).encode('utf-8')).hexdigest()[:16]
+    counts_path, mismatches_path = _cache_paths(key, cache_dir)
+    if os.path.exists(counts_path) and os.path.exists(mismatches_path):
+        return {'counts': pd.read_parquet(counts_path), 'mismatches_path': mismatches_path}
+
+    polygons = lv95_geometries(municipalities)
+    tree = polygon_index(polygons)
+    bfs_position = pd.Series(np.arange(len(bfs_numbers)), index=bfs_numbers)
+
+    counts = np.zeros(len(polygons), dtype=np.int64)
+    stated_counts = np.zeros(len(polygons), dtype=np.int64)
+    total = outside = mismatched = 0
+
+    os.makedirs(cache_dir, exist_ok=True)
+    schema = pa.schema([('id', pa.int64()), ('E_COORD', pa.float64()), ('N_COORD', pa.float64()),
+                        ('stated_bfs', pa.int64()), ('geometric_bfs', pa.int64())])
+    suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    tmp_mismatches_path = mismatches_path + suffix
+    with pq.ParquetWriter(tmp_mismatches_path, schema) as writer:
+        # Without pre-buffering the reader fetches one batch at a time instead of reading ahead
+        for batch in pq.ParquetFile(path, pre_buffer=False).iter_batches(batch_size=chunk_size,
+                                                                         columns=COMMERCIAL_COLUMNS):
+            chunk = batch.to_pandas()
+            assigned = assign_points(chunk['E_COORD'].to_numpy(), chunk['N_COORD'].to_numpy(), tree)
+            inside = assigned >= 0
+            counts += np.bincount(assigned[inside], minlength=len(polygons))
+
+            stated = chunk['BFS-Nr'].to_numpy().astype(np.int64)
+            stated_position = bfs_position.reindex(stated).to_numpy()
+            known = ~np.isnan(stated_position)
+            stated_counts += np.bincount(stated_position[known].astype(np.int64), minlength=len(polygons))
+
+            # Rows whose stated BFS number disagrees with the polygon they lie in
+            geometric = np.where(inside, bfs_numbers[np.maximum(assigned, 0)], -1)
+            differs = geometric != stated
+            if differs.any():
+                writer.write_table(pa.table({
+                    'id': chunk['id'].to_numpy()[differs],
+                    'E_COORD': chunk['E_COORD'].to_numpy()[differs],
+                    'N_COORD': chunk['N_COORD'].to_numpy()[differs],
+                    'stated_bfs': stated[differs],
+                    'geometric_bfs': geometric[differs],
+                }, schema=schema))
+
+            total += len(chunk)
+            outside += int((~inside).sum())
+            mismatched += int(differs.sum())
+    os.replace(tmp_mismatches_path, mismatches_path)
+
+    area_km2 = shapely.area(polygons) / 1e6
+    result = pd.DataFrame({
+        'BFS_NUMMER': bfs_numbers,
+        'count': counts,
+        'stated_count': stated_counts,
+        'area_km2': area_km2,
+        'density': counts / np.maximum(area_km2, 1e-6),
+    })
+    result.to_parquet(counts_path + suffix, index=False)
+    os.replace(counts_path + suffix, counts_path)
+
+    print(f"Commercial spaces: {total} rows, {outside} outside the municipalities, "
+          f"{mismatched} with a BFS number that disagrees with their location")
+    return {'counts': result, 'mismatches_path': mismatches_path}
+
+def commercial_mismatches(assignment, bfs=None, offset=0, limit=MAX_MISMATCHES):
+    """Return the number of rows whose stated BFS number disagrees with the geometry, and one page of them.
+
+    bfs keeps the rows stated in or located in that municipality; every row
+    carries its WGS84 position, and geometric_bfs is -1 outside all of them.
+    """
+    filters = None if bfs is None else [[('stated_bfs', '=', bfs)], [('geometric_bfs', '=', bfs)]]
+    mismatches = pd.read_parquet(assignment['mismatches_path'], filters=filters)
+    page = mismatches.iloc[offset:offset + limit].copy()
+    lonlat = to_wgs84(page[['E_COORD', 'N_COORD']].to_numpy())
+    page['lon'], page['lat'] = lonlat[:, 0], lonlat[:, 1]
+    return len(mismatches), page
+
+register_dataset('commercial_assignment', [COMMERCIAL_PATH], assign_commercial_spaces, depends_on=['municipalities'])
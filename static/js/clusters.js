@@ -0,0 +1,64 @@
+// clusters.js - draw the server-side point clusters of /api/clusters
+//
+// Each overlay is an empty Leaflet feature group. Whenever the map stops
+// moving, the clusters of the visible area at the current zoom are fetched and
+// replace the group's markers; a request still in flight is cancelled first.
+// Clusters are sized by their point count and zoom in on click, single points
+// open a popup with their properties.
+
+function escapeHtml(value) {
+    return String(value).replace(/[&<>"']/g, c => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[c]));
+}
+
+function clusterMarker(feature, color, map) {
+    const [lon, lat] = feature.geometry.coordinates;
+    const properties = feature.properties;
+    if (!properties.cluster) {
+        const marker = L.circleMarker([lat, lon], {radius: 5, color: color, fill: true, fillOpacity: 0.7});
+        const rows = Object.entries(properties)
+            .filter(([key, value]) => key !== 'cluster' && value !== null)
+            .map(([key, value]) => `<b>${escapeHtml(key)}</b>: ${escapeHtml(value)}`);
+        marker.bindPopup(rows.join('<br>') || 'Location');
+        return marker;
+    }
+
+    const radius = 8 + 4 * Math.log10(properties.count);
+    const marker = L.circleMarker([lat, lon], {radius: radius, color: color, weight: 2, fill: true, fillOpacity: 0.5});
+    const summary = Object.entries(properties)
+        .filter(([key, value]) => key !== 'cluster' && key !== 'count' && value !== null)
+        .map(([key, value]) => `, ${escapeHtml(key)} ${value}`);
+    marker.bindTooltip(`${properties.count} points${summary.join('')}`);
+    marker.on('click', () => map.setView([lat, lon], map.getZoom() + 2));
+    return marker;
+}
+
+function addServerClusters(group, map, layer, color) {
+    let controller = null;
+
+    function refresh() {
+        if (!map.hasLayer(group)) {
+            return;
+        }
+        const bounds = map.getBounds();
+        const bbox = [bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()];
+        if (controller) {
+            controller.abort();
+        }
+        controller = new AbortController();
+        fetch(`/api/clusters/${layer}?bbox=${bbox.join(',')}&zoom=${map.getZoom()}`, {signal: controller.signal})
+            .then(response => response.json())
+            .then(collection => {
+                group.clearLayers();
+                collection.features.forEach(feature => group.addLayer(clusterMarker(feature, color, map)));
+            })
+            .catch(error => {
+                if (error.name !== 'AbortError') {
+                    console.error(`Loading clusters of ${layer} failed`, error);
+                }
+            });
+    }
+
+    map.on('moveend', refresh);
+    group.on('add', refresh);
+    refresh();
+}
@@ -0,0 +1,148 @@
+# store.py - prepared datasets as memory-mapped Arrow IPC and NumPy files
+#
+# The first process to load a dataset writes the result once: tables as
+# uncompressed Arrow IPC files (attribute columns plus WKB geometry buffers),
+# coordinate arrays as .npy files. Every other worker, and every restart,
+# memory-maps those files read-only instead of parsing the sources again, so the
+# operating system shares their pages between workers. Entries are keyed by the
+# fingerprint of the dataset's sources and replaced when the sources change.
+#
+# Attribute columns are handed to callers as views of the mapped buffers:
+# numeric columns as read-only NumPy arrays, strings as Arrow-backed arrays.
+# Only geometries are decoded into objects each worker holds itself.
+import json
+import os
+import re
+import tempfile
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+
+STORE_DIR = os.path.join('data', 'cache', 'store')
+
+# Bump when the layout of the stored files changes
+STORE_FORMAT = 1
+
+def _base_path(name, key):
+    return os.path.join(STORE_DIR, f"{name}_{key}_v{STORE_FORMAT}")
+
+def _write_atomic(path, write):
+    """Write a file through write(f) into a temporary file and rename it into place."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _remove_stale(name, keep):
+    """Remove the stored files of older versions of a dataset."""
+    # Match the whole name: 'hotspots_coordinates' starts with 'hotspots_' too
+    pattern = re.compile(re.escape(name) + r'_[0-9a-f]{16}_v\d+\..+')
+    for file_name in os.listdir(STORE_DIR):
+        if pattern.fullmatch(file_name) and not file_name.startswith(keep + '.'):
+            try:
+                os.remove(os.path.join(STORE_DIR, file_name))
+            except OSError:
+                pass
+
+# ----- Tables -----
+
+def _fill_float_nulls(arrow_table):
+    """Store missing floats as NaN, so that reading them back needs no copy to fill in NaN."""
+    for i, field in enumerate(arrow_table.schema):
+        if pa.types.is_floating(field.type) and arrow_table.column(i).null_count:
+            filled = pc.fill_null(arrow_table.column(i), pa.scalar(float('nan'), field.type))
+            arrow_table = arrow_table.set_column(i, field, filled)
+    return arrow_table
+
+def write_table(name, key, table):
+    """Store a (Geo)DataFrame as an Arrow IPC file with WKB geometry."""
+    os.makedirs(STORE_DIR, exist_ok=True)
+    if isinstance(table, gpd.GeoDataFrame):
+        arrow_table = pa.table(table.to_arrow(geometry_encoding='WKB'))
+    else:
+        arrow_table = pa.Table.from_pandas(table)
+    arrow_table = _fill_float_nulls(arrow_table)
+
+    def write(f):
+        with ipc.new_file(f, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+    base = _base_path(name, key)
+    _write_atomic(base + '.arrow', write)
+    _remove_stale(name, os.path.basename(base))
+
+def _is_geometry(field):
+    """Return whether an Arrow field holds GeoArrow-encoded geometry."""
+    extension = (field.metadata or {}).get(b'ARROW:extension:name', b'')
+    return extension.startswith(b'geoarrow.')
+
+def read_table(name, key):
+    """Memory-map a stored table; return None if it was not stored for this key."""
+    path = _base_path(name, key) + '.arrow'
+    if not os.path.exists(path):
+        return None
+    arrow_table = ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+    # One block per column keeps the columns views of the mapped file instead of consolidated copies
+    geometry_columns = [field.name for field in arrow_table.schema if _is_geometry(field)]
+    frame = arrow_table.drop_columns(geometry_columns).to_pandas(split_blocks=True)
+    if not geometry_columns:
+        return frame
+
+    geometries = gpd.GeoDataFrame.from_arrow(arrow_table.select(geometry_columns))
+    for column in geometry_columns:
+        frame.insert(arrow_table.schema.get_field_index(column), column, geometries[column].values)
+    return gpd.GeoDataFrame(frame, geometry=geometries.geometry.name, crs=geometries.crs)
+
+# ----- Arrays -----
+
+def write_arrays(name, key, arrays):
+    """Store a dict of NumPy arrays as .npy files; the manifest is written last and marks the entry complete."""
+    os.makedirs(STORE_DIR, exist_ok=True)
+    base = _base_path(name, key)
+    for field, array in arrays.items():
+        _write_atomic(f"{base}.{field}.npy", lambda f, array=array: np.save(f, np.ascontiguousarray(array)))
+    manifest = json.dumps({'fields': list(arrays)}).encode('utf-8')
+    _write_atomic(base + '.json', lambda f: f.write(manifest))
+    _remove_stale(name, os.path.basename(base))
+
+def read_arrays(name, key):
+    """Memory-map stored arrays read-only; return None if they were not stored for this key."""
+    base = _base_path(name, key)
+    try:
+        with open(base + '.json') as f:
+            fields = json.load(f)['fields']
+    except (OSError, ValueError):
+        return None
+    return {field: np.load(f"{base}.{field}.npy", mmap_mode='r') for field in fields}
+
+# ----- Registry hooks -----
+
+WRITERS = {'table': write_table, 'arrays': write_arrays}
+READERS = {'table': read_table, 'arrays': read_arrays}
+
+def load_stored(kind, name, key, loader):
+    """Return a dataset from the store, or run loader and store its result."""
+    try:
+        value = READERS[kind](name, key)
+    except (OSError, ValueError, pa.ArrowException) as e:
+        print(f"Error reading stored dataset '{name}': {e}")
+        value = None
+    if value is not None:
+        return value
+
+    value = loader()
+    if isinstance(value, (pd.DataFrame, dict)):
+        try:
+            WRITERS[kind](name, key, value)
+        except (OSError, ValueError, TypeError, pa.ArrowException) as e:
+            print(f"Error storing dataset '{name}': {e}")
+    return value
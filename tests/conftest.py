@@ -0,0 +1,5 @@
+# conftest.py - make the application modules at the repository root importable
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,37 @@
+# test_datasets.py - incremental reading of JSON arrays without ijson
+import json
+
+import pytest
+
+import datasets
+
+CHUNK_SIZES = [1, 2, 3, 4, 5, 7, 16, 1 << 20]
+
+@pytest.fixture(autouse=True)
+def without_ijson(monkeypatch):
+    monkeypatch.setattr(datasets, 'ijson', None)
+
+def write(tmp_path, text):
+    path = tmp_path / 'array.json'
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('text', [
+    '[12.5, 3]',
+    '[1e5,-2, 3.25e-1 ,true,false,null,"a,]b"]',
+    '[{"name": "A", "types": ["store", "food"], "rating": 4.5}, {"name": "B", "rating": null}]',
+    '  [ [1, [2.75]], {"x": {"y": -0.5}} ]  ',
+    '[]',
+    '﻿[1]',
+])
+def test_iter_json_array_matches_json_loads(tmp_path, text, chunk_size):
+    path = write(tmp_path, text)
+    assert list(datasets.iter_json_array(path, chunk_size=chunk_size)) == json.loads(text.lstrip('﻿'))
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('text', ['[1, 2', '[1 2]', '[12.x]', '{"a": 1}', ''])
+def test_iter_json_array_rejects_invalid_arrays(tmp_path, text, chunk_size):
+    path = write(tmp_path, text)
+    with pytest.raises(ValueError):
+        list(datasets.iter_json_array(path, chunk_size=chunk_size))
@@ -0,0 +1,52 @@
+# test_matching.py - matching of income rows to municipalities
+import pandas as pd
+
+from matching import best_matches, match_income_names
+
+def municipalities():
+    return pd.DataFrame({
+        'BFS_NUMMER': [261, 351, 1061, 230, 2701],
+        'NAME': ['Zürich', 'Bern', 'Luzern', 'Winterthur', 'Basel'],
+    })
+
+def match(tmp_path, income):
+    return match_income_names(pd.DataFrame(income), municipalities(), 'BFS_NUMMER', 'NAME', cache_dir=str(tmp_path))
+
+def test_match_methods(tmp_path):
+    table = match(tmp_path, {
+        'id': [261, 351, 9001, 9002, 9003],
+        'municipality_name': ['Zürich', 'bern ', 'LUZERN', 'Winterthurr', 'Genève'],
+    })
+    by_id = table.set_index('income_id')
+
+    # Same BFS number and (normalized) name, then a unique name, then fuzzy names
+    assert by_id.loc[261, 'method'] == 'bfs'
+    assert by_id.loc[351, 'method'] == 'bfs'
+    assert by_id.loc[9001, ['method', 'bfs_number', 'score']].tolist() == ['name', 1061, 100]
+    assert by_id.loc[9002, ['method', 'bfs_number', 'matched_name']].tolist() == ['fuzzy', 230, 'Winterthur']
+    assert pd.isna(by_id.loc[9003, 'method'])
+    assert pd.isna(by_id.loc[9003, 'bfs_number'])
+
+    report = table.attrs['report']
+    assert report['counts'] == {'bfs': 2, 'name': 1, 'fuzzy': 1, 'unmatched': 1}
+    assert report['unmatched'] == ['Genève']
+
+def test_bfs_number_with_another_name_is_not_trusted(tmp_path):
+    table = match(tmp_path, {'id': [261], 'municipality_name': ['Basel']})
+    assert table.loc[0, ['method', 'bfs_number']].tolist() == ['name', 2701]
+
+def test_match_table_is_reused(tmp_path):
+    income = {'id': [261, 9002], 'municipality_name': ['Zürich', 'Winterthurr']}
+    first = match(tmp_path, income)
+    assert len(list(tmp_path.glob('income_matches_*.parquet'))) == 1
+    second = match(tmp_path, income)
+    pd.testing.assert_frame_equal(first, second, check_dtype=False)
+    assert second.attrs['report'] == first.attrs['report']
+
+def test_best_matches_keeps_one_row_per_municipality(tmp_path):
+    table = match(tmp_path, {'id': [351, 9001, 9002], 'municipality_name': ['Bern', 'Bern', 'Winterthurr']})
+    assert [conflict['bfs_number'] for conflict in table.attrs['report']['conflicts']] == [351]
+
+    # Equal scores keep the last income id
+    best = best_matches(table).set_index('bfs_number')['income_id']
+    assert best.to_dict() == {230: 9002, 351: 9001}
@@ -0,0 +1,38 @@
+# test_validation.py - rejection of invalid bounding boxes and locations
+import math
+
+import numpy as np
+import pytest
+
+from layers import parse_bbox
+from proximity import validate_locations
+
+def test_parse_bbox():
+    assert parse_bbox('5.9,45.8,10.5,47.8') == [5.9, 45.8, 10.5, 47.8]
+    assert parse_bbox('-180,-90,180,90') == [-180, -90, 180, 90]
+
+@pytest.mark.parametrize('value', [
+    '', '1,2,3', '1,2,3,4,5', 'a,b,c,d',
+    'nan,45,10,47', '5,45,inf,47', '-inf,45,10,47',
+    '-181,45,10,47', '5,-91,10,47', '5,45,181,47', '5,45,10,91',
+    '10,45,5,47', '5,47,10,45',
+])
+def test_parse_bbox_rejects(value):
+    with pytest.raises(ValueError):
+        parse_bbox(value)
+
+def test_validate_locations():
+    locations = validate_locations([[47.37, 8.54], [-90, 180], [0, -180]])
+    assert locations.dtype == float
+    assert locations.tolist() == [[47.37, 8.54], [-90, 180], [0, -180]]
+    assert validate_locations(np.array([[46, 7]])).tolist() == [[46.0, 7.0]]
+
+@pytest.mark.parametrize('locations', [
+    [[math.nan, 8]], [[47, math.inf]], [[-math.inf, 8]],
+    [[91, 8]], [[47, 181]], [[-90.5, 8]], [[47, -180.5]],
+    [[True, 8]], [[47, False]], [['47', 8]], [[None, 8]], [[[47], 8]],
+    np.array([[True, False]]), np.array([['47', '8']]),
+])
+def test_validate_locations_rejects(locations):
+    with pytest.raises(ValueError):
+        validate_locations(locations)
@@ -0,0 +1,91 @@
+# test_wire.py - round trips of the TopoJSON and packed point encodings
+import json
+import struct
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from wire import PACKED_MAGIC, packed_points, topojson
+
+def read_packed_points(data):
+    """Decode PTS1 bytes back into an (n, 2) coordinate array and the property columns."""
+    magic, count, length = struct.unpack_from('<4sII', data)
+    assert magic == PACKED_MAGIC
+    coordinates = np.frombuffer(data, dtype='<f4', count=count * 2, offset=12).reshape(count, 2)
+    columns = json.loads(data[12 + count * 8:12 + count * 8 + length].decode('utf-8'))
+    return coordinates, columns
+
+def decode_arcs(topology):
+    """Return the arcs of a topology as absolute coordinate arrays."""
+    scale = np.array(topology['transform']['scale'])
+    translate = np.array(topology['transform']['translate'])
+    return [np.cumsum(np.array(arc), axis=0) * scale + translate for arc in topology['arcs']]
+
+def decode_ring(arcs, references):
+    """Join the arcs of a ring, reversing those referenced as ~index."""
+    coordinates = []
+    for reference in references:
+        arc = arcs[reference] if reference >= 0 else arcs[~reference][::-1]
+        coordinates.extend(arc.tolist() if not coordinates else arc[1:].tolist())
+    return coordinates
+
+def decode_polygons(topology, name):
+    arcs = decode_arcs(topology)
+    polygons = []
+    for geometry in topology['objects'][name]['geometries']:
+        parts = [geometry['arcs']] if geometry['type'] == 'Polygon' else geometry['arcs']
+        polygons.append(shapely.MultiPolygon([
+            shapely.Polygon(decode_ring(arcs, rings[0]), [decode_ring(arcs, ring) for ring in rings[1:]])
+            for rings in parts
+        ]))
+    return polygons
+
+def test_topojson_shares_borders_and_decodes_to_the_input():
+    left = shapely.Polygon([(0, 0), (1, 0), (1, 1), (0, 1)])
+    right = shapely.Polygon([(1, 0), (2, 0), (2, 1), (1, 1)])
+    holed = shapely.Polygon([(3, 0), (5, 0), (5, 2), (3, 2)], [[(3.5, 0.5), (4.5, 0.5), (4.5, 1.5), (3.5, 1.5)]])
+    geometries = np.array([left, right, holed])
+    topology = json.loads(topojson(geometries, [{'id': 1}, {'id': 2}, {'id': 3}], 'municipalities', 3))
+
+    decoded = decode_polygons(topology, 'municipalities')
+    for original, polygon in zip(geometries, decoded):
+        assert shapely.equals_exact(shapely.normalize(original),
+                                    shapely.normalize(shapely.get_geometry(polygon, 0)), tolerance=1e-9)
+    assert [g['properties'] for g in topology['objects']['municipalities']['geometries']] == [
+        {'id': 1}, {'id': 2}, {'id': 3}]
+
+    # The border x = 1 is stored once and referenced by both squares, once reversed
+    references = [abs(r if r >= 0 else ~r)
+                  for g in topology['objects']['municipalities']['geometries'][:2]
+                  for ring in g['arcs'] for r in ring]
+    shared = [index for index in set(references) if references.count(index) == 2]
+    assert len(shared) == 1
+    arc = decode_arcs(topology)[shared[0]]
+    assert np.allclose(arc[:, 0], 1)
+
+def test_topojson_multipolygon_and_empty_geometry():
+    multi = shapely.MultiPolygon([shapely.box(0, 0, 1, 1), shapely.box(2, 2, 3, 3)])
+    topology = json.loads(topojson(np.array([multi, shapely.Polygon()]), [{}, {}], 'layer', 2))
+    geometries = topology['objects']['layer']['geometries']
+    assert geometries[0]['type'] == 'MultiPolygon'
+    assert geometries[1]['type'] is None
+    assert shapely.equals(decode_polygons({**topology, 'objects': {'layer': {'geometries': geometries[:1]}}},
+                                          'layer')[0], multi)
+
+def test_packed_points_round_trip():
+    geometries = np.array([shapely.Point(8.5, 47.25), shapely.Point(7.125, 46.5), shapely.box(0, 0, 2, 2)])
+    # Layer indexes hold missing values as None
+    properties = pd.DataFrame({'name': ['a', None, 'c'], 'rating': [4.5, 3.0, None]}, dtype=object)
+    coordinates, columns = read_packed_points(packed_points(geometries, properties))
+
+    # Points keep their position, other geometries are sent as their centroid
+    assert coordinates.dtype == np.dtype('<f4')
+    assert np.allclose(coordinates, [[8.5, 47.25], [7.125, 46.5], [1, 1]])
+    assert columns['name'] == ['a', None, 'c']
+    assert columns['rating'] == [4.5, 3.0, None]
+
+def test_packed_points_empty():
+    coordinates, columns = read_packed_points(packed_points(np.array([], dtype=object), pd.DataFrame({'name': []})))
+    assert coordinates.shape == (0, 2)
+    assert columns == {'name': []}
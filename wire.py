@@ -0,0 +1,137 @@
+# wire.py - compact encodings of map layers: quantized TopoJSON and packed points
+#
+# TopoJSON stores every border shared by two municipalities once, as an arc of
+# integer deltas on a quantization grid, and lets both polygons reference it.
+# Point layers can be sent as a packed little-endian binary buffer that a
+# client reads with a single Float32Array view; TopoJSON turns back into GeoJSON
+# with topojson-client's topojson.feature(topology, topology.objects[layer]).
+# Both formats are for API clients that ask for them on /api/layers: the maps
+# served by this app draw their layers from GeoJSON and the cluster overlays.
+# A packed point buffer is laid out as:
+#
+#   bytes 0-3    magic b'PTS1'
+#   bytes 4-7    uint32 number of points n
+#   bytes 8-11   uint32 length of the properties JSON in bytes
+#   bytes 12-    n * (float32 lon, float32 lat)
+#   then         UTF-8 JSON object of property columns, one list per column
+import json
+import struct
+
+import numpy as np
+import shapely
+
+GEOJSON = 'application/geo+json'
+TOPOJSON = 'application/topo+json'
+PACKED_POINTS = 'application/vnd.geodaten.points'
+
+PACKED_MAGIC = b'PTS1'
+
+# ----- TopoJSON -----
+
+def _quantize(coordinates, translate, scale):
+    """Return the integer grid keys of coordinates, without consecutive duplicates."""
+    grid = np.round((coordinates - translate) / scale).astype(np.int64)
+    keys = (grid[:, 0] << 32) | grid[:, 1]
+    keep = np.r_[True, keys[1:] != keys[:-1]][:len(keys)]
+    return keys[keep]
+
+def _polygon_rings(geometry):
+    """Return the rings of every polygon of a (multi)polygon as coordinate arrays."""
+    polygons = []
+    for polygon in shapely.get_parts(geometry):
+        rings = [shapely.get_exterior_ring(polygon)]
+        rings += [shapely.get_interior_ring(polygon, i) for i in range(shapely.get_num_interior_rings(polygon))]
+        polygons.append([shapely.get_coordinates(ring) for ring in rings])
+    return polygons
+
+def _junctions(rings):
+    """Return the set of grid keys where arcs must be cut: vertices with other than two distinct neighbours."""
+    starts = np.concatenate([ring[:-1] for ring in rings])
+    ends = np.concatenate([ring[1:] for ring in rings])
+    edges = np.unique(np.column_stack([np.minimum(starts, ends), np.maximum(starts, ends)]), axis=0)
+    vertices, degree = np.unique(edges.ravel(), return_counts=True)
+    return set(vertices[degree != 2].tolist())
+
+def _ring_arcs(ring, junctions):
+    """Split a closed ring of grid keys into arcs running from junction to junction."""
+    points = ring[:-1]
+    cuts = [i for i, key in enumerate(points.tolist()) if key in junctions]
+    if not cuts:
+        # A ring without junctions is one arc, started at its smallest key so
+        # that a neighbour tracing the same ring backwards produces the same arc
+        start = int(np.argmin(points))
+        rotated = np.roll(points, -start)
+        return [np.r_[rotated, rotated[:1]]]
+    rotated = np.roll(points, -cuts[0])
+    cuts = [cut - cuts[0] for cut in cuts] + [len(points)]
+    closed = np.r_[rotated, rotated[:1]]
+    return [closed[start:end + 1] for start, end in zip(cuts[:-1], cuts[1:])]
+
+def topojson(geometries, properties, name, decimals):
+    """Encode (multi)polygons as a quantized TopoJSON Topology with shared arcs stored once."""
+    bounds = shapely.total_bounds(geometries) if len(geometries) else np.zeros(4)
+    translate = bounds[:2]
+    scale = 10.0 ** -decimals
+
+    # Quantize every ring first, so that shared borders become identical key sequences
+    quantized = []
+    for geometry in geometries:
+        polygons = []
+        for rings in _polygon_rings(geometry):
+            rings = [_quantize(ring, translate, scale) for ring in rings]
+            rings = [ring for ring in rings if len(ring) >= 4]
+            if rings and len(rings[0]) >= 4:
+                polygons.append(rings)
+        quantized.append(polygons)
+    all_rings = [ring for polygons in quantized for rings in polygons for ring in rings]
+    junctions = _junctions(all_rings) if all_rings else set()
+
+    # Store each arc once; a reversed reference is written as ~index
+    arc_index = {}
+    arcs = []
+
+    def reference(arc):
+        key = tuple(arc.tolist())
+        if key in arc_index:
+            return arc_index[key]
+        reverse = key[::-1]
+        if reverse in arc_index:
+            return ~arc_index[reverse]
+        arc_index[key] = len(arcs)
+        arcs.append(arc)
+        return arc_index[key]
+
+    objects = []
+    for polygons, props in zip(quantized, properties):
+        encoded = [[[reference(arc) for arc in _ring_arcs(ring, junctions)] for ring in rings] for rings in polygons]
+        if not encoded:
+            objects.append({'type': None, 'properties': props})
+        elif len(encoded) == 1:
+            objects.append({'type': 'Polygon', 'arcs': encoded[0], 'properties': props})
+        else:
+            objects.append({'type': 'MultiPolygon', 'arcs': encoded, 'properties': props})
+
+    # Arcs are delta-encoded: the first position absolute, then differences
+    delta_arcs = []
+    for arc in arcs:
+        grid = np.column_stack([arc >> 32, arc & 0xFFFFFFFF])
+        delta_arcs.append(np.r_[grid[:1], np.diff(grid, axis=0)].tolist())
+
+    return json.dumps({
+        'type': 'Topology',
+        'transform': {'scale': [scale, scale], 'translate': translate.tolist()},
+        'objects': {name: {'type': 'GeometryCollection', 'geometries': objects}},
+        'arcs': delta_arcs,
+    }, separators=(',', ':'), default=str)
+
+# ----- Packed points -----
+
+def packed_points(geometries, properties):
+    """Encode marker positions (points as-is, centroids otherwise) and columnar properties as PTS1 bytes."""
+    is_point = shapely.get_type_id(geometries) == shapely.GeometryType.POINT
+    points = np.where(is_point, geometries, shapely.centroid(geometries))
+    coordinates = np.ascontiguousarray(shapely.get_coordinates(points), dtype='<f4')
+    columns = json.dumps({column: properties[column].tolist() for column in properties.columns},
+                         separators=(',', ':'), default=str).encode('utf-8')
+    header = struct.pack('<4sII', PACKED_MAGIC, len(coordinates), len(columns))
+    return header + coordinates.tobytes() + columns